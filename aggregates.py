@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Materialize per-run stock totals.
+
+The scraper calls materialize() for each run as it finishes.  Running this
+directly fills in the totals for any earlier runs that don't have them:
+
+    ./aggregates.py [DATABASE]
+"""
+import sys
+import time
+
+from models import _get_db_session, backfill_scrape_runs
+
+
+PREVIOUS_RUN = (
+    'SELECT MAX(timestamp) FROM scrape_runs'
+    ' WHERE finished_at IS NOT NULL AND timestamp < :timestamp')
+
+PRODUCT_TOTALS = (
+    'INSERT OR REPLACE INTO run_product_totals'
+    ' (timestamp, brand, name, total, units, combined_total, delta)'
+    ' SELECT t.timestamp, t.brand, t.name, t.total, t.units,'
+    ' t.combined_total, t.combined_total - previous.combined_total'
+    ' FROM (SELECT h.timestamp, h.brand, h.name,'
+    ' SUM(ha.size * ha.availability) AS total,'
+    ' h.standalone_availability AS units,'
+    ' COALESCE(SUM(ha.size * ha.availability), 0)'
+    ' + COALESCE(h.standalone_availability, 0) AS combined_total'
+    ' FROM history h LEFT JOIN history_availability ha'
+    ' ON ha.timestamp = h.timestamp AND ha.brand = h.brand'
+    ' AND ha.name = h.name'
+    ' WHERE h.timestamp = :timestamp GROUP BY h.brand, h.name) t'
+    ' LEFT JOIN run_product_totals previous'
+    ' ON previous.timestamp = :previous AND previous.brand = t.brand'
+    ' AND previous.name = t.name')
+
+BRAND_TOTALS = (
+    'INSERT OR REPLACE INTO run_brand_totals (timestamp, brand, total, units)'
+    ' SELECT timestamp, brand, SUM(total), SUM(units)'
+    ' FROM run_product_totals WHERE timestamp = :timestamp GROUP BY brand')
+
+RUN_TOTAL = (
+    'INSERT OR REPLACE INTO run_totals'
+    ' (timestamp, total, units, product_count)'
+    ' SELECT :timestamp, SUM(total), SUM(units), COUNT(*)'
+    ' FROM run_product_totals WHERE timestamp = :timestamp')
+
+
+def materialize(session, timestamp):
+    """Compute the totals for the run at timestamp from its history rows."""
+    previous = session.execute(
+        PREVIOUS_RUN, {'timestamp': timestamp}).scalar()
+    params = {'timestamp': timestamp, 'previous': previous}
+    for statement in [PRODUCT_TOTALS, BRAND_TOTALS, RUN_TOTAL]:
+        session.execute(statement, params)
+
+
+def backfill(session, progress=False):
+    """Materialize totals for any finished runs that don't have them."""
+    backfill_scrape_runs(session)
+    timestamps = [row[0] for row in session.execute(
+        'SELECT timestamp FROM scrape_runs WHERE finished_at IS NOT NULL'
+        ' AND timestamp NOT IN (SELECT timestamp FROM run_totals)'
+        ' ORDER BY timestamp')]
+    start = time.time()
+    for count, timestamp in enumerate(timestamps, 1):
+        materialize(session, timestamp)
+        session.commit()
+        if progress:
+            print('{}/{} runs ({:.0f}s)'.format(
+                count, len(timestamps), time.time() - start))
+    return len(timestamps)
+
+
+if __name__ == '__main__':
+    session = _get_db_session(*sys.argv[1:2])
+    print('Materialized {} runs'.format(backfill(session, progress=True)))
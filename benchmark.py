@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+"""Replay a corpus of OCS pages through OcsSpider and time it.
+
+Collection and product pages are served from fixtures/ by a downloader
+middleware, so no requests are made to ocs.ca.  Parsed products go through
+the normal SqlitePipeline into a temporary database.
+
+The pages in fixtures/ are synthetic: written by hand to have the markup
+the spider parses, not recorded from the site.  They are much smaller and
+simpler than real pages, so the numbers this gives are only good for
+comparing runs against each other (e.g. with --baseline), not as a measure
+of how fast a real crawl will be.
+
+    ./benchmark.py --copies 50
+    ./benchmark.py --copies 50 --save-baseline baseline.json
+    ./benchmark.py --copies 50 --baseline baseline.json --threshold 0.2
+
+With --baseline, the run fails if pages/sec drops more than --threshold
+(as a fraction) below the stored baseline.
+
+--workers parses product pages in a pool of that many processes (0 parses
+them in the crawl's process).  Given several counts, each is run in turn
+to show how parsing scales:
+
+    ./benchmark.py --copies 50 --workers 0 1 2 4
+
+--pages serves that many collection pages (cycling through the fixture
+ones), and --latency delays every response, to show how long it takes to
+find every product; with --serial-pagination, listing pages are found by
+following the next links one at a time, for comparison:
+
+    ./benchmark.py --pages 30 --latency 0.2
+    ./benchmark.py --pages 30 --latency 0.2 --serial-pagination
+"""
+import argparse
+import io
+import json
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from scrapy.crawler import CrawlerProcess
+from scrapy.http import HtmlResponse
+from twisted.internet import reactor, task
+
+import scraper
+
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'fixtures')
+
+_ARTICLE = re.compile(r'<article.*?</article>', re.DOTALL)
+_PRODUCT_TITLE = re.compile(r'(class="product__title">\s*)([^<]*?)(\s*<)')
+_COPY = re.compile(r'[?&]copy=(\d+)')
+_PAGINATION = re.compile(r'<ul class="pagination">.*?</ul>', re.DOTALL)
+
+
+class ReplayDownloaderMiddleware(object):
+    """Serve requests from the fixture corpus instead of the network.
+
+    With REPLAY_COPIES > 1, every product link on a collection page is
+    repeated that many times (with a ?copy=N query string), and each copy
+    gets a distinct product title so it is stored as a separate product.
+
+    With REPLAY_PAGES, that many collection pages are served, reusing the
+    fixture ones with their own copies of the products and pagination
+    rewritten to match.  REPLAY_LATENCY delays every response by that many
+    seconds.
+    """
+
+    def __init__(self, corpus_dir, copies, stats, pages=None, latency=0.0):
+        self.corpus_dir = corpus_dir
+        self.copies = copies
+        self.stats = stats
+        self.pages = pages
+        self.latency = latency
+        self._cache = {}
+        self.corpus_pages = len(os.listdir(
+            os.path.join(corpus_dir, 'collections')))
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.get('REPLAY_CORPUS', CORPUS_DIR),
+                   crawler.settings.getint('REPLAY_COPIES', 1),
+                   crawler.stats,
+                   pages=crawler.settings.getint('REPLAY_PAGES') or None,
+                   latency=crawler.settings.getfloat('REPLAY_LATENCY', 0.0))
+
+    def _read(self, *path):
+        path = os.path.join(self.corpus_dir, *path)
+        if path not in self._cache:
+            with io.open(path, encoding='utf-8') as corpus_file:
+                self._cache[path] = corpus_file.read()
+        return self._cache[path]
+
+    def _copy_article(self, match, first_copy):
+        article = match.group(0)
+        return ''.join(
+            article if copy == 0 else
+            re.sub(r'href="(/products/[^"?]+)"',
+                   r'href="\1?copy={}"'.format(copy), article)
+            for copy in range(first_copy, first_copy + self.copies))
+
+    def _pagination(self, page):
+        # Numbered links around the current page and to the last one, like
+        # the site's own
+        url = '/collections/all-cannabis-products?page={}'
+        items = ['<ul class="pagination">']
+        for number in sorted({1, self.pages} | set(range(page - 2, page + 3))):
+            if number == page:
+                items.append('<li class="pagination_current"><span>{}</span>'
+                             '</li>'.format(number))
+            elif 1 <= number <= self.pages:
+                items.append('<li><a href="{}">{}</a></li>'.format(
+                    url.format(number), number))
+        if page < self.pages:
+            items.append('<li class="pagination_next"><a href="{}">Next</a>'
+                         '</li>'.format(url.format(page + 1)))
+        items.append('</ul>')
+        return '\n'.join(items)
+
+    def _collection_body(self, url):
+        page = re.search(r'[?&]page=(\d+)', url)
+        page = int(page.group(1)) if page else 1
+        cycle, fixture_page = divmod(page - 1, self.corpus_pages)
+        body = self._read(
+            'collections', 'page-{}.html'.format(fixture_page + 1))
+        first_copy = cycle * self.copies
+        if first_copy + self.copies > 1:
+            body = _ARTICLE.sub(
+                lambda match: self._copy_article(match, first_copy), body)
+        if self.pages is not None:
+            body = _PAGINATION.sub(
+                lambda match: self._pagination(page), body)
+        return body
+
+    def _product_body(self, url):
+        handle = url.split('/products/', 1)[1].split('?', 1)[0]
+        body = self._read('products', '{}.html'.format(handle))
+        copy = _COPY.search(url)
+        if copy is not None:
+            body = _PRODUCT_TITLE.sub(
+                lambda m: '{}{} #{}{}'.format(
+                    m.group(1), m.group(2), copy.group(1), m.group(3)),
+                body, count=1)
+        return body
+
+    def process_request(self, request, spider):
+        if '/products/' in request.url:
+            body = self._product_body(request.url)
+        else:
+            body = self._collection_body(request.url)
+        self.stats.inc_value('replay/pages')
+        response = HtmlResponse(request.url, body=body, encoding='utf-8',
+                                request=request)
+        if self.latency:
+            return task.deferLater(reactor, self.latency, lambda: response)
+        return response
+
+
+def run(copies, corpus_dir=CORPUS_DIR, settings=None):
+    """Crawl the corpus once and return a dict of results."""
+    db_dir = tempfile.mkdtemp()
+    crawl_settings = {
+        'ITEM_PIPELINES': {'scraper.SqlitePipeline': 300},
+        'DOWNLOADER_MIDDLEWARES': {
+            '{}.ReplayDownloaderMiddleware'.format(__name__): 1},
+        'REPLAY_CORPUS': corpus_dir,
+        'REPLAY_COPIES': copies,
+        'SQLITE_PATH': os.path.join(db_dir, 'data.sqlite'),
+        'ROBOTSTXT_OBEY': False,
+        'LOG_LEVEL': 'WARNING',
+    }
+    crawl_settings.update(settings or {})
+    process = CrawlerProcess(crawl_settings)
+    crawler = process.create_crawler(scraper.OcsSpider)
+    start = time.time()
+    try:
+        process.crawl(crawler)
+        process.start()
+    finally:
+        shutil.rmtree(db_dir)
+    elapsed = time.time() - start
+
+    stats = crawler.stats.get_stats()
+    pages = stats.get('replay/pages', 0)
+    rows = {key.rsplit('/', 1)[1]: value for key, value in stats.items()
+            if key.startswith('sqlite/rows_written/')}
+    return {
+        'pages': pages,
+        'seconds': elapsed,
+        'pages_per_second': pages / elapsed if elapsed else 0.0,
+        'stages': {name: histogram.total for name, histogram
+                   in crawler.spider.metrics.histograms.items()},
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'rows_written': rows,
+        'discovery_seconds': stats.get('pagination/discovery_seconds'),
+    }
+
+
+def report(results):
+    print('{pages} pages in {seconds:.2f}s ({pages_per_second:.1f} pages/s)'
+          .format(**results))
+    for stage, seconds in sorted(results['stages'].items()):
+        print('  {:<18} {:8.3f}s'.format(stage, seconds))
+    if results.get('discovery_seconds') is not None:
+        print('All listing pages parsed after {:.2f}s'.format(
+            results['discovery_seconds']))
+    print('Peak RSS: {:.1f}MB'.format(results['peak_rss_kb'] / 1024.0))
+    print('Rows written: {}'.format(
+        ', '.join('{}={}'.format(table, count) for table, count
+                  in sorted(results['rows_written'].items()))))
+
+
+def check_regression(results, baseline_path, threshold):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    minimum = baseline['pages_per_second'] * (1 - threshold)
+    if results['pages_per_second'] < minimum:
+        print('REGRESSION: {:.1f} pages/s is below {:.1f} ({:.0%} under the'
+              ' baseline of {:.1f})'.format(
+                  results['pages_per_second'], minimum, threshold,
+                  baseline['pages_per_second']))
+        return False
+    print('OK: {:.1f} pages/s (baseline {:.1f})'.format(
+        results['pages_per_second'], baseline['pages_per_second']))
+    return True
+
+
+def run_scaling(copies, corpus_dir, worker_counts):
+    """Run the benchmark for each number of parse workers.
+
+    Each run is in a fresh process, as Twisted's reactor can't be restarted.
+    """
+    results = []
+    for workers in worker_counts:
+        output = subprocess.check_output([
+            sys.executable, os.path.abspath(__file__), '--json',
+            '--copies', str(copies), '--corpus', corpus_dir,
+            '--workers', str(workers)])
+        results.append((workers, json.loads(output)))
+    first = results[0][1]['pages_per_second']
+    for workers, result in results:
+        print('{:>2} workers: {:7.1f} pages/s ({:.2f}x)'.format(
+            workers, result['pages_per_second'],
+            result['pages_per_second'] / first if first else 0.0))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--copies', type=int, default=20,
+                        help='times to repeat each product in the corpus')
+    parser.add_argument('--corpus', default=CORPUS_DIR)
+    parser.add_argument('--baseline',
+                        help='fail if throughput regresses against this')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--save-baseline', metavar='PATH')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0],
+                        help='product page parsing processes')
+    parser.add_argument('--pages', type=int,
+                        help='collection pages to serve')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds to delay each response by')
+    parser.add_argument('--serial-pagination', action='store_true')
+    parser.add_argument('--json', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if len(args.workers) > 1:
+        run_scaling(args.copies, args.corpus, args.workers)
+        return
+    results = run(args.copies, corpus_dir=args.corpus, settings={
+        'PARSE_WORKERS': args.workers[0],
+        'REPLAY_PAGES': args.pages,
+        'REPLAY_LATENCY': args.latency,
+        'PAGINATION_FAN_OUT': not args.serial_pagination,
+    })
+    if args.json:
+        json.dump(results, sys.stdout)
+        return
+    report(results)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=1, sort_keys=True)
+    if args.baseline and not check_regression(
+            results, args.baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""Load a run's products into NumPy arrays for quick ad-hoc analysis.
+
+    >>> catalog = get_catalog(_get_db_session())
+    >>> catalog.per_dollar('thc', catalog.where(type='Dried Flowers'))
+    >>> catalog.grams_by_brand()
+
+Snapshots are cached by database and timestamp, so repeated analysis of
+the same run only reads the database once.  Running this directly times
+loading and querying a snapshot against the equivalent SQL:
+
+    ./catalog.py [DATABASE]
+"""
+import collections
+import sys
+import time
+
+import numpy
+
+from models import _get_db_session, backfill_scrape_runs
+
+
+PRODUCTS = (
+    'SELECT brand, name, url, type, plant_type, price, thc_low, thc_high,'
+    ' cbd_low, cbd_high, standalone_price, standalone_availability'
+    ' FROM history WHERE timestamp = :timestamp')
+
+VARIANTS = (
+    'SELECT brand, name, size, price, availability'
+    ' FROM history_availability WHERE timestamp = :timestamp')
+
+LATEST_RUN = ('SELECT MAX(timestamp) FROM scrape_runs'
+              ' WHERE finished_at IS NOT NULL')
+
+# How many snapshots get_catalog() keeps
+CACHE_SIZE = 8
+
+_snapshots = collections.OrderedDict()
+
+
+def _encode(values):
+    """Dictionary-encode values; return (codes, dictionary)."""
+    indexes = {}
+    codes = numpy.array(
+        [indexes.setdefault(value, len(indexes)) for value in values],
+        dtype=numpy.int32)
+    dictionary = [None] * len(indexes)
+    for value, index in indexes.items():
+        dictionary[index] = value
+    return codes, dictionary
+
+
+class Catalog(object):
+    """A read-only snapshot of one run's products.
+
+    Product columns are indexed by product; brand, type and plant_type are
+    stored as codes into the brands, types and plant_types lists.  Variant
+    columns (variant_product, size, variant_price, availability) have one
+    entry per size, with variant_product the index of its product.
+    """
+
+    def __init__(self, timestamp, products, variants):
+        self.timestamp = timestamp
+        (brands, self.names, self.urls, types, plant_types, price, thc_low,
+         thc_high, cbd_low, cbd_high, standalone_price,
+         standalone_availability) = (
+            zip(*products) if products else [()] * 12)
+        self.brand_codes, self.brands = _encode(brands)
+        self.type_codes, self.types = _encode(types)
+        self.plant_type_codes, self.plant_types = _encode(plant_types)
+        # Missing values become NaN
+        for column, values in [
+                ('price', price), ('thc_low', thc_low),
+                ('thc_high', thc_high), ('cbd_low', cbd_low),
+                ('cbd_high', cbd_high), ('standalone_price', standalone_price),
+                ('standalone_availability', standalone_availability)]:
+            setattr(self, column, numpy.array(values, dtype=numpy.float64))
+
+        index = {(brand, name): position for position, (brand, name)
+                 in enumerate(zip(brands, self.names))}
+        variants = [variant for variant in variants
+                    if (variant[0], variant[1]) in index]
+        self.variant_product = numpy.array(
+            [index[(brand, name)] for brand, name, _, _, _ in variants],
+            dtype=numpy.int32)
+        self.size = numpy.array([variant[2] for variant in variants],
+                                dtype=numpy.float64)
+        self.variant_price = numpy.array([variant[3] for variant in variants],
+                                         dtype=numpy.float64)
+        self.availability = numpy.array([variant[4] for variant in variants],
+                                        dtype=numpy.float64)
+
+    @classmethod
+    def load(cls, session, timestamp):
+        params = {'timestamp': timestamp}
+        return cls(timestamp,
+                   session.execute(PRODUCTS, params).fetchall(),
+                   session.execute(VARIANTS, params).fetchall())
+
+    def __len__(self):
+        return len(self.names)
+
+    def _match(self, codes, dictionary, value):
+        if value not in dictionary:
+            return numpy.zeros(len(self), dtype=bool)
+        return codes == dictionary.index(value)
+
+    def where(self, brand=None, type=None, plant_type=None):
+        """Return a mask of the products matching every given value."""
+        mask = numpy.ones(len(self), dtype=bool)
+        for codes, dictionary, value in [
+                (self.brand_codes, self.brands, brand),
+                (self.type_codes, self.types, type),
+                (self.plant_type_codes, self.plant_types, plant_type)]:
+            if value is not None:
+                mask &= self._match(codes, dictionary, value)
+        return mask
+
+    def per_dollar(self, cannabinoid='thc', mask=None, limit=5):
+        """Rank products by average THC (or CBD) % per dollar.
+
+        Returns (name, value, url) tuples, best first.
+        """
+        low = getattr(self, cannabinoid + '_low')
+        high = getattr(self, cannabinoid + '_high')
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            values = (high + low) / 2 / self.price
+        valid = numpy.isfinite(values)
+        if mask is not None:
+            valid &= mask
+        candidates = numpy.flatnonzero(valid)
+        # Stable, so ties keep the order they were scraped in
+        best = candidates[numpy.argsort(-values[candidates],
+                                        kind='mergesort')[:limit]]
+        return [(self.names[i], values[i], self.urls[i]) for i in best]
+
+    def grams_by_brand(self):
+        """Return (brand, grams available) for each brand, most first."""
+        grams = numpy.bincount(
+            self.brand_codes[self.variant_product],
+            weights=self.size * numpy.nan_to_num(self.availability),
+            minlength=len(self.brands))
+        order = numpy.argsort(-grams, kind='mergesort')
+        return [(self.brands[i], grams[i]) for i in order]
+
+    def added_since(self, other):
+        """Return the URLs of products that aren't in the other catalog."""
+        # A set beats numpy.in1d here, which sorts object arrays in Python
+        previous = set(other.urls)
+        return [url for url in self.urls if url not in previous]
+
+
+def get_catalog(session, timestamp=None):
+    """Return the snapshot for timestamp (by default, the latest run)."""
+    if timestamp is None:
+        timestamp = session.execute(LATEST_RUN).scalar()
+        if timestamp is None:
+            raise Exception('{} has no finished runs'.format(
+                session.bind.url))
+    # Copies of a database (e.g. a normalized one) share its timestamps
+    key = (str(session.bind.url), timestamp)
+    if key in _snapshots:
+        _snapshots[key] = _snapshots.pop(key)
+    else:
+        _snapshots[key] = Catalog.load(session, timestamp)
+        while len(_snapshots) > CACHE_SIZE:
+            _snapshots.popitem(last=False)
+    return _snapshots[key]
+
+
+def _time(func, repeat=20):
+    start = time.time()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.time() - start) / repeat
+
+
+def main(path='data.sqlite'):
+    session = _get_db_session(path)
+    backfill_scrape_runs(session)
+    runs = [row[0] for row in session.execute(
+        'SELECT timestamp FROM scrape_runs WHERE finished_at IS NOT NULL'
+        ' ORDER BY timestamp DESC LIMIT 2')]
+    if not runs:
+        sys.exit('{} has no finished runs'.format(path))
+    latest, previous = runs[0], runs[1] if len(runs) > 1 else None
+    start = time.time()
+    catalog = get_catalog(session, latest)
+    print('Loaded {} products, {} variants in {:.1f}ms'.format(
+        len(catalog), len(catalog.size), (time.time() - start) * 1000))
+
+    params = {'timestamp': latest, 'previous': previous}
+    # (label, query, SQL, a function giving comparable results from either)
+    comparisons = [
+        ('THC per dollar',
+         lambda: catalog.per_dollar(
+             'thc', catalog.where(type='Dried Flowers')),
+         'SELECT name, (thc_high + thc_low) / 2 / price AS value, url'
+         ' FROM history WHERE timestamp = :timestamp'
+         " AND type = 'Dried Flowers' ORDER BY value DESC LIMIT 5",
+         lambda rows: [round(row[1], 9) for row in rows]),
+        ('grams by brand', catalog.grams_by_brand,
+         'SELECT brand, SUM(size * availability) AS grams'
+         ' FROM history_availability WHERE timestamp = :timestamp'
+         ' GROUP BY brand ORDER BY grams DESC',
+         lambda rows: {brand: grams for brand, grams in rows if grams}),
+    ]
+    if previous is not None:
+        previous_catalog = get_catalog(session, previous)
+        comparisons.append(
+            ('recently added', lambda: catalog.added_since(previous_catalog),
+             'SELECT url FROM history WHERE timestamp = :timestamp'
+             ' AND url NOT IN (SELECT url FROM history'
+             ' WHERE timestamp = :previous)',
+             lambda rows: sorted(row if isinstance(row, basestring)
+                                 else row[0] for row in rows)))
+    for label, query, sql, comparable in comparisons:
+        result, seconds = _time(query)
+        sql_result, sql_seconds = _time(
+            lambda: session.execute(sql, params).fetchall())
+        same = comparable(result) == comparable(sql_result)
+        print('{:<16} {:8.3f}ms  SQL {:8.3f}ms  {}'.format(
+            label, seconds * 1000, sql_seconds * 1000,
+            'same results' if same else 'DIFFERENT RESULTS'))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Check that the service's and README's queries don't scan whole tables.
+
+Each query is run through EXPLAIN QUERY PLAN against DATABASE (or, by
+default, an empty database with the scraper's schema), and the check fails
+if any plan step is a full scan of a table.  DATABASE is opened read-only,
+so it is checked as it is, without the tables or indexes it's missing.
+
+    ./check_queries.py [DATABASE]
+"""
+import io
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+from models import _get_db_engine
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'lambda'))
+import queries  # noqa: E402
+
+
+README = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'README.md')
+
+# Scanning the (small) materialized result of a subquery is fine; these are
+# the plan steps that look like scans but aren't of a table
+_NOT_TABLE_SCANS = ('SCAN SUBQUERY', 'SCAN (subquery', 'SCAN CONSTANT ROW',
+                    'SCAN (join')
+
+
+def get_queries():
+    service_queries = [
+        ('latest run', queries.LATEST_RUN),
+        ('new products', queries.NEW_PRODUCTS.format(timestamp=0)),
+        ('new product variants', queries.NEW_PRODUCT_VARIANTS.format(
+            timestamp=0, last_timestamp=0)),
+        ('low stock', queries.LOW_STOCK),
+        ('best sellers', queries.BEST_SELLERS),
+    ]
+    with io.open(README, encoding='utf-8') as readme:
+        readme_queries = re.findall(r'```sql\n(.*?)```', readme.read(),
+                                    re.DOTALL)
+    return service_queries + [
+        ('README query {}'.format(count), query)
+        for count, query in enumerate(readme_queries, 1)]
+
+
+def full_scans(connection, query):
+    plan = connection.execute('EXPLAIN QUERY PLAN ' + query).fetchall()
+    details = [row[-1] for row in plan]
+    # Named subqueries (e.g. "FROM (SELECT ...) old") show up as co-routines
+    # or materializations, and are then scanned by name
+    subqueries = {detail.split(' ', 1)[1] for detail in details
+                  if detail.startswith(('CO-ROUTINE ', 'MATERIALIZE '))}
+    return [detail for detail in details
+            if detail.startswith('SCAN ')
+            and not detail.startswith(_NOT_TABLE_SCANS)
+            and detail.split(' ')[1] not in subqueries]
+
+
+def _connect_read_only(path):
+    if not os.path.exists(path):
+        sys.exit('{} does not exist'.format(path))
+    connection = sqlite3.connect(path)
+    # Python 2's sqlite3 can't open a "file:...?mode=ro" URI
+    connection.execute('PRAGMA query_only = ON')
+    return connection
+
+
+def check(connection):
+    failed = False
+    for label, query in get_queries():
+        scans = full_scans(connection, query)
+        if scans:
+            failed = True
+            print('FAIL {}: {}'.format(label, '; '.join(scans)))
+        else:
+            print('ok   {}'.format(label))
+    return not failed
+
+
+def main():
+    if len(sys.argv) > 1:
+        connection = _connect_read_only(sys.argv[1])
+        try:
+            passed = check(connection)
+        finally:
+            connection.close()
+    else:
+        db_dir = tempfile.mkdtemp()
+        try:
+            engine = _get_db_engine(os.path.join(db_dir, 'data.sqlite'))
+            connection = engine.raw_connection()
+            try:
+                passed = check(connection)
+            finally:
+                connection.close()
+                engine.dispose()
+        finally:
+            shutil.rmtree(db_dir)
+    if not passed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,56 +1,135 @@
 #!/usr/bin/env python
+import itertools
 import json
+import os
+import time
 
 import jinja2
-from sqlalchemy import func
+from sqlalchemy import func, or_
 
-from scraper import (
-    HistoricalListing, HistoricalProductAvailability, _get_db_session)
+import aggregates
+from models import GraphPoint, RunBrandTotal, RunTotal, _get_db_session
 
 
-def _get_total_datapoints(session):
+# Bucket widths, in seconds, for each resolution that is stored
+RESOLUTIONS = [('raw', None), ('hourly', 60 * 60), ('daily', 24 * 60 * 60)]
+
+# How far back from the latest run each resolution is drawn; anything older
+# than HOURLY_WINDOW is drawn from the daily points
+RAW_WINDOW = 2 * 24 * 60 * 60
+HOURLY_WINDOW = 30 * 24 * 60 * 60
+
+
+def _get_total_datapoints(session, since):
+    query = session.query(RunTotal.timestamp, RunTotal.total).filter(
+        RunTotal.timestamp >= since, RunTotal.total.isnot(None))
+    return [('Total', timestamp, total) for timestamp, total in query]
+
+
+def _get_per_brand_datapoints(session, since):
     query = session.query(
-        HistoricalProductAvailability.timestamp.label('timestamp'),
-        func.sum(HistoricalProductAvailability.size *
-                 HistoricalProductAvailability.availability).label('amount')
-    ).group_by(HistoricalProductAvailability.timestamp)
-    print(str(query))
-    data_points = []
-    for instance in query:
-        instance_dict = instance._asdict()
-        instance_dict['timestamp'] *= 1000
-        instance_dict['label'] = 'Total'
-        data_points.append(instance_dict)
-    return data_points
-
-
-def _get_per_brand_datapoints(session):
+        RunBrandTotal.brand, RunBrandTotal.timestamp, RunBrandTotal.total
+    ).filter(RunBrandTotal.timestamp >= since, RunBrandTotal.total.isnot(None))
+    return query.all()
+
+
+def _downsample(data_points, width):
+    """Keep the lowest and highest point of each series in each bucket.
+
+    Unlike averaging, this keeps the spikes and dips that make a stock graph
+    worth looking at.
+    """
+    def bucket(point):
+        series, timestamp, _ = point
+        return series, timestamp - timestamp % width
+
+    for _, points in itertools.groupby(sorted(data_points), bucket):
+        points = list(points)
+        lowest = min(points, key=lambda point: point[2])
+        highest = max(points, key=lambda point: point[2])
+        for point in sorted({lowest, highest}):
+            yield point
+
+
+def update_graph_points(session):
+    """Add the runs since the last update to graph_points.
+
+    Only buckets that the new runs fall into are rebuilt.
+    """
+    last = session.query(func.max(GraphPoint.timestamp)).filter(
+        GraphPoint.resolution == 'raw').scalar()
+    first = session.query(func.min(RunTotal.timestamp)).filter(
+        RunTotal.timestamp > (last if last is not None else -1)).scalar()
+    if first is None:
+        return 0
+    for resolution, width in RESOLUTIONS:
+        since = first if width is None else first - first % width
+        session.query(GraphPoint).filter(
+            GraphPoint.resolution == resolution,
+            GraphPoint.timestamp >= since).delete(synchronize_session=False)
+        data_points = _get_total_datapoints(session, since)
+        data_points.extend(_get_per_brand_datapoints(session, since))
+        if width is not None:
+            data_points = _downsample(data_points, width)
+        session.bulk_insert_mappings(GraphPoint, [
+            {'resolution': resolution, 'series': series,
+             'timestamp': timestamp, 'amount': amount}
+            for series, timestamp, amount in data_points])
+    session.commit()
+    return session.query(RunTotal).filter(RunTotal.timestamp >= first).count()
+
+
+def _get_datapoints(session):
+    """Return the points to draw as columns, finest for the latest runs."""
+    latest = session.query(func.max(GraphPoint.timestamp)).filter(
+        GraphPoint.resolution == 'raw').scalar() or 0
+    raw_since = latest - RAW_WINDOW
+    raw_since -= raw_since % RESOLUTIONS[1][1]
+    hourly_since = latest - HOURLY_WINDOW
+    hourly_since -= hourly_since % RESOLUTIONS[2][1]
     query = session.query(
-        HistoricalProductAvailability.timestamp.label('timestamp'),
-        HistoricalListing.brand.label('label'),
-        func.sum(HistoricalProductAvailability.size *
-                 HistoricalProductAvailability.availability).label('amount')
-    ).join(HistoricalListing).group_by(HistoricalListing.brand,
-                                       HistoricalListing.timestamp)
-    print(str(query))
-    data_points = []
-    for instance in query:
-        instance_dict = instance._asdict()
-        instance_dict['timestamp'] *= 1000
-        data_points.append(instance_dict)
-    return data_points
+        GraphPoint.series, GraphPoint.timestamp, GraphPoint.amount
+    ).filter(or_(
+        (GraphPoint.resolution == 'daily')
+        & (GraphPoint.timestamp < hourly_since),
+        (GraphPoint.resolution == 'hourly')
+        & (GraphPoint.timestamp >= hourly_since)
+        & (GraphPoint.timestamp < raw_since),
+        (GraphPoint.resolution == 'raw')
+        & (GraphPoint.timestamp >= raw_since),
+    )).order_by(GraphPoint.series, GraphPoint.timestamp)
+
+    # Columns rather than a list of objects, with each series' label stored
+    # once, keep the page small; graph.html.j2 expands them again
+    columns = {'labels': [], 'label': [], 'timestamp': [], 'amount': []}
+    label_indexes = {}
+    for series, timestamp, amount in query:
+        if series not in label_indexes:
+            label_indexes[series] = len(columns['labels'])
+            columns['labels'].append(series)
+        columns['label'].append(label_indexes[series])
+        columns['timestamp'].append(timestamp)
+        columns['amount'].append(round(amount, 1))
+    return columns
 
 
 def main():
+    start = time.time()
     session = _get_db_session()
-    data_points = _get_total_datapoints(session)
-    data_points.extend(_get_per_brand_datapoints(session))
+    # Fill in the totals for any runs from before they were materialized
+    aggregates.backfill(session)
+    print('Added {} runs to the graph points'.format(
+        update_graph_points(session)))
+    columns = _get_datapoints(session)
     with open('graph.html.j2') as template_file:
         template = jinja2.Template(template_file.read())
     with open('output.html', 'w') as output_file:
         output_file.write(
             template.render(
-                {'data_points': json.dumps(data_points, indent=1)}))
+                {'data_points': json.dumps(columns, separators=(',', ':'))}))
+    print('Wrote {} points to output.html ({:.1f}KB) in {:.1f}s'.format(
+        len(columns['timestamp']), os.path.getsize('output.html') / 1024.0,
+        time.time() - start))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""Find what changed in each run since the previous one.
+
+The scraper calls detect() for each run as it finishes, writing the
+changes to the events table.  Running this directly finds the events for
+any earlier runs that haven't been compared:
+
+    ./events.py [DATABASE]
+"""
+import sys
+import time
+
+import aggregates
+from models import (
+    Event, EventRun, _get_db_session, backfill_scrape_runs)
+
+
+KINDS = ['new', 'delisted', 'restocked', 'price_change', 'low_stock', 'sold']
+
+# The same threshold as the service's low stock query
+LOW_STOCK_THRESHOLD = 100
+
+PRODUCTS = (
+    'SELECT brand, name, url, standalone_price, standalone_availability'
+    ' FROM history WHERE timestamp = :timestamp')
+
+VARIANTS = (
+    'SELECT brand, name, size, price, availability'
+    ' FROM history_availability WHERE timestamp = :timestamp')
+
+
+def load_run(session, timestamp):
+    """Return a run's products, keyed on (brand, name).
+
+    Each product's variants are keyed on size, with None for a product
+    that is sold without sizes.
+    """
+    products = {}
+    for brand, name, url, price, availability in session.execute(
+            PRODUCTS, {'timestamp': timestamp}):
+        variants = {}
+        if price is not None or availability is not None:
+            variants[None] = (price, availability)
+        products[(brand, name)] = {'url': url, 'variants': variants}
+    for brand, name, size, price, availability in session.execute(
+            VARIANTS, {'timestamp': timestamp}):
+        product = products.get((brand, name))
+        if product is not None:
+            product['variants'][size] = (price, availability)
+    return products
+
+
+def _combined_total(product):
+    # As in run_product_totals: grams across all sizes, plus units
+    return sum((size if size is not None else 1) * (availability or 0)
+               for size, (_, availability) in product['variants'].items())
+
+
+def _variant_events(old, new):
+    for size in set(old['variants']) | set(new['variants']):
+        old_price, old_availability = old['variants'].get(size, (None, None))
+        new_price, new_availability = new['variants'].get(size, (None, None))
+        old_availability = old_availability or 0
+        new_availability = new_availability or 0
+        if (old_price is not None and new_price is not None
+                and old_price != new_price):
+            yield 'price_change', size, old_price, new_price
+        if old_availability <= 0 < new_availability:
+            yield 'restocked', size, old_availability, new_availability
+        elif new_availability < old_availability:
+            yield 'sold', size, None, old_availability - new_availability
+
+
+def diff(previous, current):
+    """Yield (kind, key, size, old_value, new_value) for each change."""
+    for key, product in current.items():
+        old = previous.get(key)
+        if old is None:
+            yield 'new', key, None, None, _combined_total(product)
+            continue
+        for kind, size, old_value, new_value in _variant_events(old, product):
+            yield kind, key, size, old_value, new_value
+        old_total = _combined_total(old)
+        new_total = _combined_total(product)
+        if new_total < LOW_STOCK_THRESHOLD <= old_total:
+            yield 'low_stock', key, None, old_total, new_total
+    for key, product in previous.items():
+        if key not in current:
+            yield 'delisted', key, None, _combined_total(product), None
+
+
+def detect(session, timestamp):
+    """Write the events for the run at timestamp; return counts by kind."""
+    previous = session.execute(
+        aggregates.PREVIOUS_RUN, {'timestamp': timestamp}).scalar()
+    session.query(Event).filter_by(timestamp=timestamp).delete()
+    counts = {}
+    rows = []
+    if previous is not None:
+        previous_products = load_run(session, previous)
+        current_products = load_run(session, timestamp)
+        for kind, key, size, old_value, new_value in diff(
+                previous_products, current_products):
+            # Delisted products are only in the previous run
+            product = current_products.get(key) or previous_products[key]
+            rows.append({
+                'timestamp': timestamp, 'kind': kind, 'brand': key[0],
+                'name': key[1], 'url': product['url'], 'size': size,
+                'old_value': old_value, 'new_value': new_value,
+            })
+            counts[kind] = counts.get(kind, 0) + 1
+        session.bulk_insert_mappings(Event, rows)
+    session.merge(EventRun(timestamp=timestamp, previous=previous,
+                           event_count=len(rows)))
+    return counts
+
+
+def backfill(session, progress=False):
+    """Find events for any finished runs that haven't been compared."""
+    backfill_scrape_runs(session)
+    timestamps = [row[0] for row in session.execute(
+        'SELECT timestamp FROM scrape_runs WHERE finished_at IS NOT NULL'
+        ' AND timestamp NOT IN (SELECT timestamp FROM event_runs)'
+        ' ORDER BY timestamp')]
+    start = time.time()
+    for count, timestamp in enumerate(timestamps, 1):
+        detect(session, timestamp)
+        session.commit()
+        if progress:
+            print('{}/{} runs ({:.0f}s)'.format(
+                count, len(timestamps), time.time() - start))
+    return len(timestamps)
+
+
+if __name__ == '__main__':
+    session = _get_db_session(*sys.argv[1:2])
+    print('Compared {} runs'.format(backfill(session, progress=True)))
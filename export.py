@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""Export history and history_availability for analysis.
+
+Rows are streamed out of SQLite a chunk at a time and written to one file
+per run, partitioned by day:
+
+    OUTPUT/history/date=2018-10-17/1539787521.parquet
+    OUTPUT/history_availability/date=2018-10-17/1539787521.parquet
+
+Parquet (with brand, name and type dictionary-encoded) is written if
+pyarrow is installed; otherwise, or with --format csv, gzipped CSV is.
+Re-running only exports runs newer than the last one exported.
+
+    ./export.py [--database data.sqlite] [--format csv] OUTPUT
+"""
+import argparse
+import csv
+import datetime
+import gzip
+import json
+import os
+import resource
+import time
+
+from sqlalchemy import Float, Integer, select
+
+from models import (
+    HistoricalListing, HistoricalProductAvailability, _get_db_session,
+    backfill_scrape_runs)
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+DICTIONARY_COLUMNS = ['brand', 'name', 'type']
+STATE_FILE = '_export_state.json'
+
+
+def _arrow_type(column):
+    if isinstance(column.type, Integer):
+        return pyarrow.int64()
+    if isinstance(column.type, Float):
+        return pyarrow.float64()
+    return pyarrow.string()
+
+
+class ParquetPartWriter(object):
+    extension = '.parquet'
+
+    def __init__(self, path, table):
+        self.columns = [column.name for column in table.columns]
+        self.schema = pyarrow.schema([
+            pyarrow.field(column.name, _arrow_type(column))
+            for column in table.columns])
+        self.writer = pyarrow.parquet.ParquetWriter(
+            path, self.schema, compression='snappy',
+            use_dictionary=[column for column in DICTIONARY_COLUMNS
+                            if column in self.columns])
+
+    def write(self, rows):
+        arrays = [
+            pyarrow.array([row[index] for row in rows], type=field.type)
+            for index, field in enumerate(self.schema)]
+        self.writer.write_table(
+            pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class CsvPartWriter(object):
+    extension = '.csv.gz'
+
+    def __init__(self, path, table):
+        self.file = gzip.open(path, 'wb')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([column.name for column in table.columns])
+
+    def write(self, rows):
+        self.writer.writerows(
+            [value.encode('utf-8') if isinstance(value, unicode) else value
+             for value in row] for row in rows)
+
+    def close(self):
+        self.file.close()
+
+
+def _load_state(output):
+    path = os.path.join(output, STATE_FILE)
+    if not os.path.exists(path):
+        return {'last_timestamp': 0}
+    with open(path) as state_file:
+        return json.load(state_file)
+
+
+def _save_state(output, state):
+    path = os.path.join(output, STATE_FILE)
+    with open(path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file)
+    os.rename(path + '.tmp', path)
+
+
+def _export_run(connection, table, timestamp, output, writer_class,
+                chunk_size):
+    day = datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d')
+    directory = os.path.join(output, table.name, 'date={}'.format(day))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, str(timestamp) + writer_class.extension)
+
+    result = connection.execution_options(stream_results=True).execute(
+        select([table]).where(table.c.timestamp == timestamp))
+    # Write to a temporary name, so an interrupted export doesn't leave a
+    # partial file that looks complete
+    writer = writer_class(path + '.tmp', table)
+    count = 0
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            writer.write(rows)
+            count += len(rows)
+    finally:
+        writer.close()
+        result.close()
+    os.rename(path + '.tmp', path)
+    return count
+
+
+def export(database, output, writer_class, chunk_size=10000):
+    session = _get_db_session(database)
+    backfill_scrape_runs(session)
+    session.commit()
+    state = _load_state(output)
+    timestamps = [row[0] for row in session.execute(
+        'SELECT timestamp FROM scrape_runs WHERE finished_at IS NOT NULL'
+        ' AND timestamp > :last ORDER BY timestamp',
+        {'last': state['last_timestamp']})]
+    connection = session.connection()
+
+    start = time.time()
+    total = 0
+    for count, timestamp in enumerate(timestamps, 1):
+        for model in [HistoricalListing, HistoricalProductAvailability]:
+            total += _export_run(connection, model.__table__, timestamp,
+                                 output, writer_class, chunk_size)
+        state['last_timestamp'] = timestamp
+        _save_state(output, state)
+        elapsed = time.time() - start
+        print('{}/{} runs, {} rows ({:.0f} rows/s)'.format(
+            count, len(timestamps), total, total / elapsed if elapsed else 0))
+    session.close()
+
+    elapsed = time.time() - start
+    print('Exported {} rows from {} runs in {:.1f}s ({:.0f} rows/s)'.format(
+        total, len(timestamps), elapsed, total / elapsed if elapsed else 0))
+    print('Peak memory: {:.1f}MB'.format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output')
+    parser.add_argument('--database', default='data.sqlite')
+    parser.add_argument(
+        '--format', choices=['parquet', 'csv'],
+        default='parquet' if pyarrow is not None else 'csv')
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    if args.format == 'parquet':
+        if pyarrow is None:
+            parser.error('writing Parquet needs pyarrow to be installed')
+        writer_class = ParquetPartWriter
+    else:
+        writer_class = CsvPartWriter
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    export(args.database, args.output, writer_class, args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
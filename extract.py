@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""Pull the Shopify variant and inventory data out of product page scripts.
+
+Building a full slimit AST of these scripts (and calling to_ecma() on every
+node to find what we're after) dominates the per-page CPU cost of the
+scraper, so we scan for the literals we need directly and only fall back to
+slimit if the page doesn't look the way we expect.
+"""
+import io
+import json
+import re
+import sys
+import time
+
+from slimit.parser import Parser
+from slimit.visitors import nodevisitor
+
+
+class ScanError(ValueError):
+    pass
+
+
+_OPENERS = {'{': '}', '[': ']'}
+_INVENTORY_ENTRY = re.compile(r'^\s*(\d+)\s*:\s*(-?\d+)\s*$')
+
+_slimit_parser = None
+
+
+def _get_slimit_parser():
+    global _slimit_parser
+    if _slimit_parser is None:
+        _slimit_parser = Parser()
+    return _slimit_parser
+
+
+def _skip_whitespace(text, index):
+    while index < len(text) and text[index].isspace():
+        index += 1
+    return index
+
+
+def _match_brackets(text, start):
+    """Return the index just past the bracket that closes text[start].
+
+    String literals are skipped over, so brackets inside them don't count.
+    """
+    if start >= len(text) or text[start] not in _OPENERS:
+        raise ScanError('No opening bracket at {}'.format(start))
+    stack = []
+    index = start
+    length = len(text)
+    while index < length:
+        char = text[index]
+        if char in _OPENERS:
+            stack.append(_OPENERS[char])
+        elif char == '}' or char == ']':
+            if not stack or stack.pop() != char:
+                raise ScanError('Unbalanced {!r} at {}'.format(char, index))
+            if not stack:
+                return index + 1
+        elif char == '"' or char == "'":
+            index += 1
+            while index < length and text[index] != char:
+                if text[index] == '\\':
+                    index += 1
+                index += 1
+        index += 1
+    raise ScanError('Unterminated literal starting at {}'.format(start))
+
+
+def _scan_variants(script_content):
+    key_index = script_content.find('"variants":')
+    if key_index == -1:
+        raise ScanError('No variants found')
+    start = _skip_whitespace(script_content, key_index + len('"variants":'))
+    end = _match_brackets(script_content, start)
+    try:
+        return json.loads(script_content[start:end])
+    except ValueError as exc:
+        raise ScanError(str(exc))
+
+
+def _scan_inventory_quantities(script_content):
+    match = re.search(r'\binventory_quantities\s*=\s*', script_content)
+    if match is None:
+        raise ScanError('No inventory_quantities found')
+    start = match.end()
+    end = _match_brackets(script_content, start)
+    body = script_content[start + 1:end - 1]
+    quantities = {}
+    if not body.strip():
+        return quantities
+    # The object uses integer keys, so we can't just json.loads it
+    for entry in body.split(','):
+        entry_match = _INVENTORY_ENTRY.match(entry)
+        if entry_match is None:
+            raise ScanError('Unexpected inventory entry: {!r}'.format(entry))
+        quantities[int(entry_match.group(1))] = int(entry_match.group(2))
+    return quantities
+
+
+def _slimit_variants(script_content):
+    tree = _get_slimit_parser().parse(script_content)
+    for node in nodevisitor.visit(tree):
+        if node.to_ecma().startswith('"variants":'):
+            return json.loads(node.right.to_ecma())
+    raise Exception('No variants found')
+
+
+def _slimit_inventory_quantities(script_content):
+    # slimit chokes on the full content, so just use the line we care about
+    inventory_quantities_line = next(
+        line for line in script_content.splitlines()
+        if 'var inventory_quantities' in line)
+    tree = _get_slimit_parser().parse(inventory_quantities_line)
+    quantities = {}
+    for node in nodevisitor.visit(tree):
+        if node.to_ecma().startswith('inventory_quantities ='):
+            for assign in node.initializer.children():
+                quantities[int(assign.left.to_ecma())] = int(
+                    assign.right.to_ecma())
+    return quantities
+
+
+def extract_variants(script_content):
+    """Return the list of variant dicts from a Shopify `var meta` script."""
+    try:
+        return _scan_variants(script_content)
+    except ScanError:
+        return _slimit_variants(script_content)
+
+
+def extract_inventory_quantities(script_content):
+    """Return {variant id: quantity} from an `inventory_quantities` script."""
+    try:
+        return _scan_inventory_quantities(script_content)
+    except ScanError:
+        return _slimit_inventory_quantities(script_content)
+
+
+def get_product_scripts(selector):
+    """Return the (meta, inventory) script contents from a product page."""
+    shopify_script_content = selector.xpath(
+        '//script[contains(text(), "var meta =")]/text()').extract_first()
+    inventory_script_content = selector.xpath(
+        '//script[contains(text(), "var inventory_quantities =")]'
+        '/text()').extract_first()
+    return shopify_script_content, inventory_script_content
+
+
+def _time(func, scripts, iterations):
+    start = time.time()
+    for _ in range(iterations):
+        for script in scripts:
+            func(script)
+    return (time.time() - start) / (iterations * len(scripts))
+
+
+def main(paths, iterations=20):
+    from parsel import Selector
+
+    meta_scripts, inventory_scripts = [], []
+    for path in paths:
+        with io.open(path, encoding='utf-8') as html_file:
+            selector = Selector(text=html_file.read())
+        meta, inventory = get_product_scripts(selector)
+        if _scan_variants(meta) != _slimit_variants(meta):
+            raise Exception('Variant mismatch in {}'.format(path))
+        if (_scan_inventory_quantities(inventory)
+                != _slimit_inventory_quantities(inventory)):
+            raise Exception('Inventory mismatch in {}'.format(path))
+        meta_scripts.append(meta)
+        inventory_scripts.append(inventory)
+
+    print('{} pages, {} iterations'.format(len(paths), iterations))
+    for label, scripts, fast, slow in [
+            ('variants', meta_scripts, _scan_variants, _slimit_variants),
+            ('inventory', inventory_scripts, _scan_inventory_quantities,
+             _slimit_inventory_quantities)]:
+        fast_time = _time(fast, scripts, iterations)
+        slow_time = _time(slow, scripts, max(1, iterations // 10))
+        print('{:<10} scanner {:8.3f}ms  slimit {:8.3f}ms  ({:.0f}x)'.format(
+            label, fast_time * 1000, slow_time * 1000, slow_time / fast_time))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit('usage: extract.py PRODUCT_HTML...')
+    main(sys.argv[1:])
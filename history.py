@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+"""Normalized, change-only storage for product history.
+
+The wide history table repeats every column of every product on every run.
+In normalized storage, the static attributes of a product are kept in
+products, with a new version only when one of them changes, and
+product_snapshots/snapshot_availability only get a new row when a
+product's attributes, price, potency or per-size availability change; a
+snapshot's last_seen is moved forward for each run in which the product is
+seen unchanged.  history and history_availability become views with the
+same shape as the old tables, so existing queries keep working.
+
+To convert an existing database (SOURCE is left untouched):
+
+    ./history.py data.sqlite data-normalized.sqlite
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from collections import defaultdict
+
+from sqlalchemy import Column, Float, Index, Integer, Text
+from sqlalchemy import bindparam, distinct, text
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import class_mapper, sessionmaker
+
+from models import (
+    HistoricalListing, HistoricalProductAvailability, ProductListing,
+    _get_db_engine)
+
+
+HistoryBase = declarative_base()
+
+STATIC_FIELDS = ['sku', 'url', 'description', 'type', 'image', 'plant_type',
+                 'terpenes']
+VOLATILE_FIELDS = ['price', 'thc_low', 'thc_high', 'cbd_low', 'cbd_high',
+                   'standalone_price', 'standalone_availability']
+
+
+class Product(HistoryBase):
+    __tablename__ = 'products'
+    brand = Column(Text, primary_key=True)
+    name = Column(Text, primary_key=True)
+    # The first run in which the product was seen with these values
+    timestamp = Column(Integer, primary_key=True)
+    sku = Column(Text)
+    url = Column(Text)
+    description = Column(Text)
+    type = Column(Text)
+    image = Column(Text)
+    plant_type = Column(Text)
+    terpenes = Column(Text)
+
+
+class ProductSnapshot(HistoryBase):
+    __tablename__ = 'product_snapshots'
+    brand = Column(Text, primary_key=True)
+    name = Column(Text, primary_key=True)
+    # The first and last runs in which the product was seen with these values
+    timestamp = Column(Integer, primary_key=True)
+    last_seen = Column(Integer, nullable=False)
+    # The version of the product's static attributes seen in these runs
+    product_timestamp = Column(Integer)
+    price = Column(Float)
+    thc_low = Column(Integer)
+    thc_high = Column(Integer)
+    cbd_low = Column(Integer)
+    cbd_high = Column(Integer)
+    standalone_price = Column(Integer)
+    standalone_availability = Column(Integer)
+
+    __table_args__ = (
+        Index('ix_product_snapshots_last_seen', 'last_seen'),
+    )
+
+
+class SnapshotAvailability(HistoryBase):
+    __tablename__ = 'snapshot_availability'
+    brand = Column(Text, primary_key=True)
+    name = Column(Text, primary_key=True)
+    timestamp = Column(Integer, primary_key=True)
+    size = Column(Float, primary_key=True)
+    availability = Column(Integer)
+    price = Column(Integer)
+
+
+class SnapshotRun(HistoryBase):
+    __tablename__ = 'snapshot_runs'
+    timestamp = Column(Integer, primary_key=True)
+
+
+HISTORY_VIEW_SQL = (
+    'CREATE VIEW history AS SELECT p.sku, p.url, s.brand, s.name, s.price,'
+    ' p.description, p.type, p.image, p.plant_type, p.terpenes, s.thc_low,'
+    ' s.thc_high, s.cbd_low, s.cbd_high, s.standalone_price,'
+    ' s.standalone_availability, r.timestamp AS timestamp'
+    ' FROM snapshot_runs r JOIN product_snapshots s'
+    ' ON s.timestamp <= r.timestamp AND s.last_seen >= r.timestamp'
+    ' JOIN products p ON p.brand = s.brand AND p.name = s.name'
+    ' AND p.timestamp = s.product_timestamp')
+
+
+HISTORY_AVAILABILITY_VIEW_SQL = (
+    'CREATE VIEW history_availability AS'
+    ' SELECT r.timestamp AS timestamp, a.brand AS brand, a.name AS name,'
+    ' a.size AS size, a.availability AS availability, a.price AS price'
+    ' FROM snapshot_runs r JOIN product_snapshots s'
+    ' ON s.timestamp <= r.timestamp AND s.last_seen >= r.timestamp'
+    ' JOIN snapshot_availability a ON a.brand = s.brand AND a.name = s.name'
+    ' AND a.timestamp = s.timestamp')
+
+
+def _object_type(bind, name):
+    return bind.execute(
+        text('SELECT type FROM sqlite_master WHERE name = :name'),
+        {'name': name}).scalar()
+
+
+def is_normalized(bind):
+    return _object_type(bind, 'history') == 'view'
+
+
+def create_schema(engine):
+    """Set up normalized storage, replacing empty wide history tables."""
+    HistoryBase.metadata.create_all(engine)
+    if is_normalized(engine):
+        return
+    for table in ['history_availability', 'history']:
+        if _object_type(engine, table) != 'table':
+            continue
+        if engine.execute('SELECT COUNT(*) FROM {}'.format(table)).scalar():
+            raise Exception(
+                '{} already has data; convert it with history.py'.format(
+                    table))
+        engine.execute('DROP TABLE {}'.format(table))
+    engine.execute(HISTORY_VIEW_SQL)
+    engine.execute(HISTORY_AVAILABILITY_VIEW_SQL)
+
+
+_LATEST_SNAPSHOTS = (
+    ' JOIN (SELECT brand, name, MAX(timestamp) AS timestamp'
+    ' FROM product_snapshots GROUP BY brand, name) latest'
+    ' ON {0}.brand = latest.brand AND {0}.name = latest.name'
+    ' AND {0}.timestamp = latest.timestamp')
+
+
+class SnapshotWriter(object):
+    """Write only the product data that has changed since the last run."""
+
+    def __init__(self, session):
+        self.session = session
+        self.previous_run = session.execute(
+            'SELECT MAX(timestamp) FROM snapshot_runs').scalar()
+        self.latest = self._load_latest()
+        self._products = []
+        self._snapshots = []
+        self._availabilities = []
+        self._extended = []
+
+    def _load_latest(self):
+        latest = {}
+        for row in self.session.execute(
+                'SELECT s.*, {} FROM product_snapshots s'.format(
+                    ', '.join('p.' + field for field in STATIC_FIELDS)) +
+                _LATEST_SNAPSHOTS.format('s') +
+                ' JOIN products p ON p.brand = s.brand AND p.name = s.name'
+                ' AND p.timestamp = s.product_timestamp'):
+            latest[(row.brand, row.name)] = {
+                'timestamp': row.timestamp,
+                'last_seen': row.last_seen,
+                'product_timestamp': row.product_timestamp,
+                'static': tuple(row[field] for field in STATIC_FIELDS),
+                'volatile': tuple(row[field] for field in VOLATILE_FIELDS),
+                'sizes': {},
+            }
+        for row in self.session.execute(
+                'SELECT a.* FROM snapshot_availability a' +
+                _LATEST_SNAPSHOTS.format('a')):
+            latest[(row.brand, row.name)]['sizes'][row.size] = (
+                row.price, row.availability)
+        return latest
+
+    def add(self, timestamp, listing, availability_rows):
+        key = (listing['brand'], listing['name'])
+        static = tuple(listing.get(field) for field in STATIC_FIELDS)
+        volatile = tuple(listing.get(field) for field in VOLATILE_FIELDS)
+        sizes = {row['size']: (row['price'], row['availability'])
+                 for row in availability_rows}
+        previous = self.latest.get(key)
+        if previous is not None and previous['static'] == static:
+            product_timestamp = previous['product_timestamp']
+        else:
+            # A new version, so earlier runs keep the values they were
+            # scraped with
+            product_timestamp = timestamp
+            product = dict(zip(STATIC_FIELDS, static))
+            product.update(brand=key[0], name=key[1], timestamp=timestamp)
+            self._products.append(product)
+        if (previous is not None
+                and previous['last_seen'] == self.previous_run
+                and previous['product_timestamp'] == product_timestamp
+                and previous['volatile'] == volatile
+                and previous['sizes'] == sizes):
+            previous['last_seen'] = timestamp
+            self._extended.append({
+                'snapshot_brand': key[0], 'snapshot_name': key[1],
+                'snapshot_timestamp': previous['timestamp'],
+                'new_last_seen': timestamp})
+            return
+
+        snapshot = dict(zip(VOLATILE_FIELDS, volatile))
+        snapshot.update(brand=key[0], name=key[1], timestamp=timestamp,
+                        last_seen=timestamp,
+                        product_timestamp=product_timestamp)
+        self._snapshots.append(snapshot)
+        for size, (price, availability) in sizes.items():
+            self._availabilities.append({
+                'brand': key[0], 'name': key[1], 'timestamp': timestamp,
+                'size': size, 'price': price, 'availability': availability})
+        self.latest[key] = {'timestamp': timestamp, 'last_seen': timestamp,
+                            'product_timestamp': product_timestamp,
+                            'static': static, 'volatile': volatile,
+                            'sizes': sizes}
+
+    def flush(self):
+        """Write buffered rows; returns the number of rows per table."""
+        written = {}
+        for model, rows in [(Product, self._products),
+                            (ProductSnapshot, self._snapshots),
+                            (SnapshotAvailability, self._availabilities)]:
+            if rows:
+                self.session.execute(model.__table__.insert(), rows)
+                written[model.__tablename__] = len(rows)
+        if self._extended:
+            table = ProductSnapshot.__table__
+            self.session.execute(
+                table.update().where(
+                    (table.c.brand == bindparam('snapshot_brand'))
+                    & (table.c.name == bindparam('snapshot_name'))
+                    & (table.c.timestamp == bindparam('snapshot_timestamp'))
+                ).values(last_seen=bindparam('new_last_seen')),
+                self._extended)
+            written['product_snapshots_extended'] = len(self._extended)
+        self._products = []
+        self._snapshots = []
+        self._availabilities = []
+        self._extended = []
+        return written
+
+    def finish_run(self, timestamp):
+        written = self.flush()
+        self.session.execute(SnapshotRun.__table__.insert(),
+                             [{'timestamp': timestamp}])
+        self.previous_run = timestamp
+        return written
+
+
+def migrate(source, dest):
+    shutil.copyfile(source, dest)
+    # Creates any of the scraper's tables that the database predates
+    engine = _get_db_engine(dest)
+    if is_normalized(engine):
+        raise Exception('{} is already normalized'.format(source))
+    HistoryBase.metadata.create_all(engine)
+    session = sessionmaker(engine)()
+    # Imported here, as sizes.py uses this module too
+    import sizes
+    # Runs from before history_availability only have the legacy columns
+    sizes.backfill(session)
+    writer = SnapshotWriter(session)
+    listing_attrs = [
+        prop.key for prop in class_mapper(ProductListing).column_attrs]
+
+    timestamps = [row[0] for row in session.query(
+        distinct(HistoricalListing.timestamp)).order_by(
+            HistoricalListing.timestamp)]
+    start = time.time()
+    for count, timestamp in enumerate(timestamps, 1):
+        availability = defaultdict(list)
+        for row in session.query(HistoricalProductAvailability).filter_by(
+                timestamp=timestamp):
+            availability[(row.brand, row.name)].append({
+                'size': row.size, 'price': row.price,
+                'availability': row.availability})
+        for listing in session.query(HistoricalListing).filter_by(
+                timestamp=timestamp):
+            listing = {attr: getattr(listing, attr) for attr in listing_attrs}
+            writer.add(timestamp, listing, availability.get(
+                (listing['brand'], listing['name']), []))
+        writer.finish_run(timestamp)
+        session.commit()
+        session.expunge_all()
+        print('{}/{} runs converted ({:.0f}s)'.format(
+            count, len(timestamps), time.time() - start))
+
+    engine.execute('DROP TABLE history_availability')
+    engine.execute('DROP TABLE history')
+    engine.execute(HISTORY_VIEW_SQL)
+    engine.execute(HISTORY_AVAILABILITY_VIEW_SQL)
+    engine.dispose()
+
+    connection = sqlite3.connect(dest)
+    connection.execute('VACUUM')
+    for table in ['products', 'product_snapshots', 'snapshot_availability']:
+        print('{}: {} rows'.format(table, connection.execute(
+            'SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]))
+    connection.close()
+    before, after = os.path.getsize(source), os.path.getsize(dest)
+    print('{}: {:.1f}MB -> {}: {:.1f}MB ({:.0%} of the original size)'.format(
+        source, before / 1e6, dest, after / 1e6, float(after) / before))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('usage: history.py SOURCE DEST')
+    migrate(sys.argv[1], sys.argv[2])
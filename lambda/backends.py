@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Ways for the service to run SQL against the scraper's database."""
+import os
+import shutil
+import sqlite3
+
+
+MORPH_API_URL = (
+    'https://api.morph.io/OddBloke/ontario_cannabis_store_scraper/data.json')
+
+
+class MorphBackend(object):
+    """Query the morph.io API, reusing one HTTP connection for every query."""
+
+    def __init__(self, api_key, url=MORPH_API_URL, session=None):
+        self.api_key = api_key
+        self.url = url
+        if session is None:
+            import requests
+            session = requests.Session()
+        self.session = session
+
+    def query(self, query):
+        print('QUERY: {}'.format(query))
+        r = self.session.get(self.url, params={
+            'key': self.api_key,
+            'query': query,
+        })
+        r.raise_for_status()
+        ret = r.json()
+        print(ret)
+        return ret
+
+
+class SqliteBackend(object):
+    """Query a local copy of data.sqlite directly."""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+
+    @classmethod
+    def download(cls, url, path):
+        import requests
+        response = requests.get(url, stream=True)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        with open(path, 'wb') as database_file:
+            shutil.copyfileobj(response.raw, database_file)
+        return cls(path)
+
+    def query(self, query):
+        print('QUERY: {}'.format(query))
+        return [dict(row) for row in self.connection.execute(query)]
+
+
+def get_backend():
+    """Pick a backend based on the environment.
+
+    OCS_DATABASE may be the path of a local data.sqlite, or a URL to download
+    one from (into /tmp, which is writable on Lambda); otherwise the morph.io
+    API is used with MORPH_API_KEY.
+    """
+    database = os.environ.get('OCS_DATABASE')
+    if database is None:
+        return MorphBackend(os.environ['MORPH_API_KEY'])
+    if database.startswith(('http://', 'https://')):
+        return SqliteBackend.download(database, '/tmp/data.sqlite')
+    return SqliteBackend(database)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time cold and warm invocations of the service's handler.
+
+State is kept in a local DynamoDB (DynamoDB Local, or moto_server) and the
+products are read from a local database, seeded so that the invocations
+have nothing to post:
+
+    DYNAMODB_ENDPOINT_URL=http://localhost:8000 OCS_DATABASE=data.sqlite \\
+        ./benchmark.py --invocations 20
+
+A cold invocation is timed in a fresh Python process, from importing
+service.py to the handler returning.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+class Context(object):
+
+    def get_remaining_time_in_millis(self):
+        return 60 * 1000
+
+
+def _seed(client, table_name):
+    """Create the state table, with nothing due to be posted."""
+    import backends
+    import queries
+    if table_name not in client.list_tables()['TableNames']:
+        client.create_table(
+            TableName=table_name,
+            KeySchema=[{'AttributeName': 'last_timestamp', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[
+                {'AttributeName': 'last_timestamp', 'AttributeType': 'S'}],
+            ProvisionedThroughput={
+                'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+    backend = backends.get_backend()
+    now = int(time.time())
+    latest = backend.query(queries.LATEST_RUN)[0].values()[0]
+    state = {
+        'last_timestamp': str(latest),
+        'low_stock_updates': {
+            entry['sku']: now for entry in backend.query(queries.LOW_STOCK)},
+        'fun_facts': {'24h_best_sellers': now},
+    }
+    from state import StateStore
+    store = StateStore(table_name, client)
+    if client.scan(TableName=table_name)['Count']:
+        store.load()
+    else:
+        store.version = 0
+    store.save(state)
+
+
+def _invoke(invocations):
+    # Runs in a fresh process: the first invocation is cold
+    start = time.time()
+    import service
+    imported = time.time()
+    timings = []
+    for _ in range(invocations):
+        invocation_start = time.time()
+        service.handler({}, Context())
+        timings.append(time.time() - invocation_start)
+    return {
+        'import': imported - start,
+        'cold': imported - start + timings[0],
+        'warm': timings[1:],
+        'modules': sorted(name for name in ['boto3', 'requests', 'twitter']
+                          if name in sys.modules),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--invocations', type=int, default=10)
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    # The local DynamoDB doesn't check these, but boto3 needs them set
+    for name, value in [('AWS_DEFAULT_REGION', 'us-east-1'),
+                        ('AWS_ACCESS_KEY_ID', 'local'),
+                        ('AWS_SECRET_ACCESS_KEY', 'local')]:
+        os.environ.setdefault(name, value)
+
+    if args.child:
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                results = _invoke(args.invocations)
+            finally:
+                sys.stdout = stdout
+        json.dump(results, sys.stdout)
+        return
+
+    import state
+    _seed(state.get_client(), state.STATE_TABLE)
+    results = json.loads(subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), '--child',
+        '--invocations', str(args.invocations)]))
+    warm = sorted(results['warm'])
+    print('Cold: {:.0f}ms ({:.0f}ms importing service.py)'.format(
+        results['cold'] * 1000, results['import'] * 1000))
+    if warm:
+        print('Warm: {:.1f}ms median, {:.1f}ms max over {} invocations'.format(
+            warm[len(warm) // 2] * 1000, warm[-1] * 1000, len(warm)))
+    print('Loaded: {}'.format(', '.join(results['modules']) or 'none'))
+
+
+if __name__ == '__main__':
+    main()
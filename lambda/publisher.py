@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""Post statuses to Twitter without losing any when things go wrong.
+
+Images are downloaded and uploaded by a small pool of threads ahead of the
+posts that need them, posts go out in order at a rate Twitter will accept,
+transient failures are retried with backoff, and whatever hasn't been posted
+when we hit a rate limit or run out of time is returned to the caller (so it
+can be saved and posted by the next invocation).
+"""
+import os
+import tempfile
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+
+# statuses/update allows 300 posts per 3 hours
+DEFAULT_RATE = 300 / (3 * 60 * 60.0)
+DEFAULT_BURST = 5
+
+# Twitter error codes: rate limit exceeded, over the daily update limit
+RATE_LIMIT_CODES = {88, 185}
+# Status is a duplicate; retrying won't help, and it has been posted before
+DUPLICATE_CODES = {187}
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate=DEFAULT_RATE, capacity=DEFAULT_BURST,
+                 clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Return how long acquire() would currently have to wait."""
+        with self.lock:
+            self._refill()
+            return max(0.0, (1 - self.tokens) / self.rate)
+
+    def acquire(self):
+        with self.lock:
+            self._refill()
+            if self.tokens < 1:
+                self.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+def _error_codes(exc):
+    # python-twitter's TwitterError carries the API's list of errors
+    message = getattr(exc, 'message', None)
+    if isinstance(message, list):
+        return {error.get('code') for error in message
+                if isinstance(error, dict)}
+    return set()
+
+
+def download_image(url, session=None):
+    """Download url into a temporary file that python-twitter can upload."""
+    if session is None:
+        import requests
+        session = requests
+    response = session.get(url, timeout=10)
+    response.raise_for_status()
+    extension = os.path.splitext(url.split('?', 1)[0])[1] or '.jpg'
+    image_file = tempfile.NamedTemporaryFile(mode='w+b', suffix=extension)
+    image_file.write(response.content)
+    image_file.seek(0)
+    return image_file
+
+
+class Publisher(object):
+
+    def __init__(self, api, fetch_image=download_image, workers=4,
+                 bucket=None, max_attempts=3, backoff=2.0, deadline=None,
+                 on_progress=None, clock=time.time, sleep=time.sleep):
+        self.api = api
+        self.fetch_image = fetch_image
+        self.workers = workers
+        self.bucket = bucket if bucket is not None else TokenBucket(
+            clock=clock, sleep=sleep)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.deadline = deadline
+        self.on_progress = on_progress
+        self.clock = clock
+        self.sleep = sleep
+
+    def _time_left(self):
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - self.clock())
+
+    def _out_of_time(self, wait=0.0):
+        return (self.deadline is not None
+                and self.clock() + wait >= self.deadline)
+
+    def _retry(self, func, *args, **kwargs):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as exc:
+                codes = _error_codes(exc)
+                if codes & (RATE_LIMIT_CODES | DUPLICATE_CODES):
+                    raise
+                if attempt == self.max_attempts:
+                    raise
+                delay = self.backoff * 2 ** (attempt - 1)
+                print('Attempt {} failed ({!r}); retrying in {}s'.format(
+                    attempt, exc, delay))
+                self.sleep(delay)
+
+    def _upload(self, image_file):
+        # A failed attempt may have read some or all of the file
+        image_file.seek(0)
+        return self.api.UploadMediaSimple(image_file)
+
+    def _prepare_media(self, image):
+        if image is None:
+            return None
+        try:
+            image_file = self._retry(self.fetch_image, image)
+            try:
+                return self._retry(self._upload, image_file)
+            finally:
+                image_file.close()
+        except Exception as exc:
+            # Better to post without the image than not at all
+            print('Could not prepare {}: {!r}'.format(image, exc))
+            return None
+
+    def publish(self, statuses):
+        """Post (status, image) pairs in order.
+
+        Returns the pairs that weren't posted.
+        """
+        statuses = list(statuses)
+        if not statuses:
+            return []
+        pool = ThreadPool(self.workers)
+        try:
+            media = []
+            for index, (status, _) in enumerate(statuses):
+                if self._out_of_time(self.bucket.wait_time()):
+                    print('Out of time; leaving {} statuses'.format(
+                        len(statuses) - index))
+                    return statuses[index:]
+                # Only prepare the images a few statuses ahead, as the
+                # bucket or the deadline may leave the rest for the next
+                # invocation, which would upload them again
+                while len(media) < min(index + self.workers, len(statuses)):
+                    media.append(pool.apply_async(
+                        self._prepare_media, (statuses[len(media)][1],)))
+                self.bucket.acquire()
+                try:
+                    media_id = media[index].get(self._time_left())
+                except TimeoutError:
+                    print('Out of time waiting for {!r}'.format(status))
+                    return statuses[index:]
+                try:
+                    print(self._retry(self.api.PostUpdate, status,
+                                      media=media_id))
+                except Exception as exc:
+                    codes = _error_codes(exc)
+                    if not codes & DUPLICATE_CODES:
+                        print('Stopping at {!r}: {!r}'.format(status, exc))
+                        return statuses[index:]
+                    print('Skipping duplicate {!r}'.format(status))
+                if self.on_progress is not None:
+                    self.on_progress(statuses[index + 1:])
+            return []
+        finally:
+            pool.terminate()
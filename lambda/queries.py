@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""SQL run against the scraper's database by the service.
+
+These are kept separate from service.py so check_queries.py can check their
+query plans without the service's dependencies.
+"""
+
+# scrape_runs has a partial index on finished runs, so this is a single
+# index lookup rather than a sort of every timestamp in history
+LATEST_RUN = ('SELECT MAX(timestamp) FROM scrape_runs'
+              ' WHERE finished_at IS NOT NULL')
+
+# The events table has a 'new' event for each product that wasn't in the
+# run before it, so the candidates are a few index lookups rather than an
+# anti-join of two whole runs.  A product that was missing from some runs in
+# between and came back also has one, so those still in the run at
+# {timestamp} (by URL, as they were before events existed) are left out
+NEW_PRODUCTS = (
+    'SELECT * FROM history h'
+    ' WHERE h.timestamp = (' + LATEST_RUN + ')'
+    " AND EXISTS (SELECT 1 FROM events e WHERE e.kind = 'new'"
+    ' AND e.brand = h.brand AND e.name = h.name'
+    ' AND e.timestamp > {timestamp})'
+    ' AND NOT EXISTS (SELECT 1 FROM history p'
+    ' WHERE p.timestamp = {timestamp} AND p.url = h.url)')
+
+# The variants of every product in NEW_PRODUCTS, given its timestamp
+NEW_PRODUCT_VARIANTS = (
+    'SELECT ha.* FROM history_availability ha'
+    ' JOIN history h ON h.timestamp = ha.timestamp'
+    ' AND h.brand = ha.brand AND h.name = ha.name'
+    ' WHERE ha.timestamp = {timestamp}'
+    " AND EXISTS (SELECT 1 FROM events e WHERE e.kind = 'new'"
+    ' AND e.brand = ha.brand AND e.name = ha.name'
+    ' AND e.timestamp > {last_timestamp})'
+    ' AND NOT EXISTS (SELECT 1 FROM history p'
+    ' WHERE p.timestamp = {last_timestamp} AND p.url = h.url)')
+
+# run_product_totals is materialized by the scraper at the end of each run
+LOW_STOCK = (
+    'SELECT h.brand,h.sku,h.image,h.url,h.name,h.standalone_availability,'
+    't.combined_total'
+    ' FROM run_product_totals t JOIN history h'
+    ' ON h.timestamp = t.timestamp AND h.brand = t.brand AND h.name = t.name'
+    ' WHERE t.timestamp = (' + LATEST_RUN + ') AND t.combined_total < 100'
+    ' ORDER BY t.combined_total')
+
+# Sold estimates are per size, from each run's decreases in availability
+BEST_SELLERS = (
+    'SELECT e.brand,e.name,h.image,SUM(e.size * e.new_value)/1000 AS sold'
+    ' FROM events e JOIN history h'
+    ' ON h.timestamp = e.timestamp AND h.brand = e.brand AND h.name = e.name'
+    " WHERE e.kind = 'sold' AND e.size IS NOT NULL"
+    " AND e.timestamp > strftime('%s', 'now', '-1 day')"
+    ' GROUP BY e.brand, e.name ORDER BY sold DESC LIMIT 3')
@@ -1,35 +1,26 @@
 # -*- coding: utf-8 -*-
 import os
+import time
 from datetime import datetime, timedelta
 
-import boto3
-import requests
-import twitter
+import queries
+from backends import get_backend
+from publisher import Publisher
+from state import StateStore
 
 
 TWEET_PREFIX = (
     'New availability on Ontario Cannabis Store:\n{name} by {brand_twitter}')
 TWEET_SUFFIX = '\n#ocs\n{url}'
 BRAND_TWITTERS = {}
+# Seconds before the Lambda timeout at which to stop posting
+PUBLISH_TIME_MARGIN = 10
 
 LOW_STOCK_MSG = ('Ontario Cannabis Store are running low on:\n{name} by'
                  ' {brand_twitter}\nOnly {combined_total} {units} left!'
                  + TWEET_SUFFIX)
 
 
-def _do_request(query):
-    print 'QUERY:', query
-    morph_api_url = "https://api.morph.io/OddBloke/ontario_cannabis_store_scraper/data.json"
-    morph_api_key = os.environ['MORPH_API_KEY']
-    r = requests.get(morph_api_url, params={
-        'key': morph_api_key,
-        'query': query,
-    })
-    ret = r.json()
-    print(ret)
-    return ret
-
-
 def _fix_image(image):
     if image is not None and not image.startswith('http'):
         return 'https:' + image
@@ -47,12 +38,8 @@ def _get_standalone_tweet_content(entry):
         entry, ' (${price:.2f}, {standalone_availability} left)\n')
 
 
-def _get_variant_tweet_content(entry):
+def _get_variant_tweet_content(entry, data):
     # Determine the relevant variants
-    data = _do_request(
-        'SELECT * FROM history_availability'
-        ' WHERE timestamp={timestamp} AND brand="{brand}"'
-        ' AND name="{name}"'.format(**entry))
     variants = {d['size']: d for d in data if d['availability']}
     print(variants)
     content = '\n'
@@ -66,11 +53,9 @@ def _get_variant_tweet_content(entry):
     return _format_status(entry, content)
 
 
-def low_stock_tweets(current_state):
+def low_stock_tweets(current_state, backend):
     statuses = []
-    data = _do_request(
-        'SELECT brand,sku,image,url,name,standalone_availability,COALESCE(total, 0) + COALESCE(standalone_availability, 0) AS combined_total FROM (SELECT h.brand,h.name,h.sku,image,url,standalone_availability,SUM(size*availability) as total FROM history h LEFT JOIN history_availability ha ON h.timestamp = ha.timestamp AND h.brand = ha.brand AND h.name = ha.name WHERE h.timestamp = (SELECT DISTINCT timestamp FROM history ORDER BY timestamp DESC LIMIT 1) GROUP BY h.sku) WHERE combined_total < 100 ORDER BY combined_total',
-    )
+    data = backend.query(queries.LOW_STOCK)
     update_cutoff = datetime.now() - timedelta(hours=8)
     print 'Update cutoff:', update_cutoff
     last_updates = current_state.get('low_stock_updates', {})
@@ -94,14 +79,12 @@ def low_stock_tweets(current_state):
     return current_state, statuses
 
 
-def fun_fact_tweets(current_state):
+def fun_fact_tweets(current_state, backend):
     statuses = []
     update_cutoff = datetime.now() - timedelta(hours=8)
     last_updates = current_state.get('fun_facts', {})
     if datetime.fromtimestamp(last_updates.get('24h_best_sellers', 0)) < update_cutoff:
-        data = _do_request(
-            "SELECT old.brand,old.name,old.image,old.total AS before,new.total AS after,(COALESCE(old.total, 0)-COALESCE(new.total, 0))/1000 as sold FROM (SELECT history.brand,history.name,history.image,SUM(availability*size) AS total FROM history JOIN history_availability ON history.brand = history_availability.brand AND history.name = history_availability.name AND history.timestamp = history_availability.timestamp AND history.timestamp = (SELECT DISTINCT timestamp FROM history WHERE timestamp < strftime('%s', 'now', '-1 day') ORDER BY timestamp DESC LIMIT 1) GROUP BY history.brand, history.name) old LEFT JOIN (SELECT history.brand,history.name,SUM(availability*size) AS total FROM history JOIN history_availability ON history.brand = history_availability.brand AND history.name = history_availability.name AND history.timestamp = history_availability.timestamp AND history.timestamp = (SELECT DISTINCT timestamp FROM history ORDER BY timestamp DESC LIMIT 1) GROUP BY history.brand, history.name) new ON old.brand = new.brand AND old.name = new.name ORDER BY sold DESC LIMIT 3"
-        )
+        data = backend.query(queries.BEST_SELLERS)
         status = 'Top selling strains on Ontario Cannabis Store (last 24 hours):\n'
         image = None
         for entry in data:
@@ -122,12 +105,64 @@ def fun_fact_tweets(current_state):
     return current_state, statuses
 
 
-def handler_for_timestamp(current_state, debug=False):
+def _get_new_product_variants(backend, data, last_timestamp):
+    # Fetch the variants for all the new products in one query
+    variants = {}
+    if not any(entry['standalone_price'] is None for entry in data):
+        return variants
+    for variant in backend.query(queries.NEW_PRODUCT_VARIANTS.format(
+            timestamp=data[0]['timestamp'], last_timestamp=last_timestamp)):
+        variants.setdefault(
+            (variant['brand'], variant['name']), []).append(variant)
+    return variants
+
+
+def _get_twitter_api():
+    # Imported here so invocations with nothing to post don't pay for it
+    import twitter
+    return twitter.Api(
+        consumer_key=os.environ['TWITTER_CONSUMER_KEY'],
+        consumer_secret=os.environ['TWITTER_CONSUMER_SECRET'],
+        access_token_key=os.environ['TWITTER_ACCESS_TOKEN_KEY'],
+        access_token_secret=os.environ['TWITTER_ACCESS_TOKEN_SECRET'])
+
+
+def _publish(current_state, statuses, save_state=None, deadline=None):
+    """Post statuses, keeping any that couldn't be posted in the state."""
+    if not statuses:
+        current_state.pop('pending_statuses', None)
+        return
+
+    def on_progress(remaining):
+        current_state['pending_statuses'] = [list(s) for s in remaining]
+        if save_state is not None:
+            save_state(current_state)
+
+    publisher = Publisher(_get_twitter_api(), deadline=deadline,
+                          on_progress=on_progress)
+    remaining = publisher.publish(statuses)
+    if remaining:
+        current_state['pending_statuses'] = [list(s) for s in remaining]
+    else:
+        current_state.pop('pending_statuses', None)
+
+
+def handler_for_timestamp(current_state, debug=False, backend=None,
+                          save_state=None, deadline=None):
+    pending = current_state.get('pending_statuses')
+    if pending:
+        # A previous invocation didn't get to post all of its statuses
+        print('Resuming {} pending statuses'.format(len(pending)))
+        if not debug:
+            _publish(current_state, [tuple(s) for s in pending],
+                     save_state=save_state, deadline=deadline)
+        return str(pending), current_state
+
+    if backend is None:
+        backend = get_backend()
     timestamp = current_state['last_timestamp']
-    data = _do_request(
-        'SELECT * FROM history'
-        ' WHERE timestamp = (SELECT DISTINCT timestamp FROM history ORDER BY timestamp DESC LIMIT 1)'
-        ' AND url NOT IN (SELECT url FROM history WHERE timestamp = {})'.format(timestamp))
+    data = backend.query(queries.NEW_PRODUCTS.format(timestamp=timestamp))
+    variants = _get_new_product_variants(backend, data, timestamp)
 
     statuses = []
     new_timestamp = None
@@ -136,7 +171,8 @@ def handler_for_timestamp(current_state, debug=False):
         if entry['standalone_price'] is not None:
             status = _get_standalone_tweet_content(entry)
         else:
-            status = _get_variant_tweet_content(entry)
+            status = _get_variant_tweet_content(
+                entry, variants.get((entry['brand'], entry['name']), []))
         print(status, len(status))
         statuses.append((status, image))
         new_timestamp = entry['timestamp']
@@ -146,37 +182,30 @@ def handler_for_timestamp(current_state, debug=False):
 
     if not statuses:
         # No new products, look for low-stock products to notify about
-        current_state, statuses = low_stock_tweets(current_state)
+        current_state, statuses = low_stock_tweets(current_state, backend)
 
     if not statuses:
         # No new product or low-stock updates, fun fact time
-        current_state, statuses = fun_fact_tweets(current_state)
+        current_state, statuses = fun_fact_tweets(current_state, backend)
 
     if not debug:
-        api = twitter.Api(
-            consumer_key=os.environ['TWITTER_CONSUMER_KEY'],
-            consumer_secret=os.environ['TWITTER_CONSUMER_SECRET'],
-            access_token_key=os.environ['TWITTER_ACCESS_TOKEN_KEY'],
-            access_token_secret=os.environ['TWITTER_ACCESS_TOKEN_SECRET'])
-        for (status, image) in statuses:
-            print(api.PostUpdate(status, media=image))
+        _publish(current_state, statuses, save_state=save_state,
+                 deadline=deadline)
     return str(data), current_state
 
 
 def handler(event, context):
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table('ocs_tweeter')
-    response = table.scan()
-    assert len(response['Items']) == 1
-    current_state = response['Items'][0]
-    last_timestamp = current_state['last_timestamp']
+    store = StateStore()
+    current_state = store.load()
 
-    response_text, new_state = handler_for_timestamp(current_state)
+    # Leave enough time to save the state after the last post
+    deadline = (time.time() + context.get_remaining_time_in_millis() / 1000.0
+                - PUBLISH_TIME_MARGIN)
+    response_text, new_state = handler_for_timestamp(
+        current_state, save_state=store.save, deadline=deadline)
 
     if new_state is not None:
-        table.delete_item(
-            Key={'last_timestamp': last_timestamp})
-        table.put_item(Item=new_state)
+        store.save(new_state)
 
     return {
         'statusCode': 200,
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""The service's state, kept in a single DynamoDB item.
+
+The item has a fixed key, so it can be read with one GetItem; saves are
+conditional on its version, so two overlapping invocations can't overwrite
+each other's progress.
+"""
+import os
+
+
+STATE_TABLE = os.environ.get('OCS_STATE_TABLE', 'ocs_tweeter')
+# The table's hash key is last_timestamp, from when the state was stored
+# under its own last_timestamp
+STATE_KEY = {'last_timestamp': {'S': 'state'}}
+
+# Created on first use and kept for later invocations of a warm Lambda
+_clients = {}
+
+
+def get_client():
+    if 'dynamodb' not in _clients:
+        import boto3
+        # DYNAMODB_ENDPOINT_URL points at a local DynamoDB for testing
+        _clients['dynamodb'] = boto3.client(
+            'dynamodb', endpoint_url=os.environ.get('DYNAMODB_ENDPOINT_URL'))
+    return _clients['dynamodb']
+
+
+class StateConflict(Exception):
+    """The state was saved by another invocation since it was loaded."""
+
+
+class StateStore(object):
+
+    def __init__(self, table_name=STATE_TABLE, client=None):
+        from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+        self.table_name = table_name
+        self.client = client if client is not None else get_client()
+        self.serializer = TypeSerializer()
+        self.deserializer = TypeDeserializer()
+        self.version = None
+        self._legacy_key = None
+
+    def load(self):
+        item = self.client.get_item(
+            TableName=self.table_name, Key=STATE_KEY,
+            ConsistentRead=True).get('Item')
+        if item is None:
+            return self._load_legacy()
+        self.version = int(item['version']['N'])
+        return self.deserializer.deserialize(item['state'])
+
+    def _load_legacy(self):
+        # The state used to be the table's only item; it is moved to
+        # STATE_KEY by the first save
+        items = self.client.scan(TableName=self.table_name)['Items']
+        assert len(items) == 1
+        self._legacy_key = {'last_timestamp': items[0]['last_timestamp']}
+        self.version = 0
+        return {key: self.deserializer.deserialize(value)
+                for key, value in items[0].items()}
+
+    def save(self, state):
+        try:
+            self.client.update_item(
+                TableName=self.table_name, Key=STATE_KEY,
+                UpdateExpression='SET #state = :state, #version = :next',
+                ConditionExpression=('attribute_not_exists(#version)'
+                                     ' OR #version = :version'),
+                ExpressionAttributeNames={
+                    '#state': 'state', '#version': 'version'},
+                ExpressionAttributeValues={
+                    ':state': self.serializer.serialize(state),
+                    ':next': {'N': str(self.version + 1)},
+                    ':version': {'N': str(self.version)},
+                })
+        except self.client.exceptions.ConditionalCheckFailedException:
+            raise StateConflict(
+                'State was saved elsewhere since version {}'.format(
+                    self.version))
+        self.version += 1
+        if self._legacy_key is not None:
+            self.client.delete_item(
+                TableName=self.table_name, Key=self._legacy_key)
+            self._legacy_key = None
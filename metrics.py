@@ -0,0 +1,114 @@
+"""Counters and timing histograms for the stages of a crawl.
+
+Each crawl has a Metrics object (OcsSpider.metrics) that the spider and
+pipeline record into; SqlitePipeline writes it to scrape_metrics when the
+crawl closes.  Pages parsed in a pool process are recorded into their own
+Metrics, which is sent back with the result and merged.
+"""
+import contextlib
+import time
+
+
+# Histogram bucket upper bounds, in seconds: 10us doubling up to ~84s
+BUCKETS = [0.00001 * 2 ** i for i in range(24)]
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        index = 0
+        while index < len(BUCKETS) and value > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        for value in [other.min, other.max]:
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percent):
+        """Return the upper bound of the bucket the percentile falls in."""
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if index == len(BUCKETS):
+                    break
+                return min(self.max, BUCKETS[index])
+        return self.max
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, count=1):
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def observe(self, name, value):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        self.histograms[name].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def merge(self, other):
+        for name, count in other.counters.items():
+            self.inc(name, count)
+        for name, histogram in other.histograms.items():
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].merge(histogram)
+
+    def rows(self, timestamp):
+        """Return the metrics as scrape_metrics rows."""
+        rows = [{'timestamp': timestamp, 'name': name, 'kind': 'counter',
+                 'count': count}
+                for name, count in sorted(self.counters.items())]
+        for name, histogram in sorted(self.histograms.items()):
+            rows.append({
+                'timestamp': timestamp, 'name': name, 'kind': 'timer',
+                'count': histogram.count, 'total': histogram.total,
+                'min': histogram.min, 'max': histogram.max,
+                'p50': histogram.percentile(50),
+                'p90': histogram.percentile(90),
+                'p99': histogram.percentile(99),
+            })
+        return rows
+
+    def log(self, logger):
+        for name, histogram in sorted(self.histograms.items()):
+            logger.info(
+                'Stage %s: %d in %.3fs (p50 %.4fs, p99 %.4fs, max %.4fs)',
+                name, histogram.count, histogram.total,
+                histogram.percentile(50), histogram.percentile(99),
+                histogram.max)
+        for name, count in sorted(self.counters.items()):
+            logger.info('Counter %s: %d', name, count)
@@ -0,0 +1,310 @@
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy import (
+    Column, Float, ForeignKeyConstraint, Index, Integer, Text)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+
+Base = declarative_base()
+
+
+class ProductMixin(object):
+    sku = Column(Text)
+    url = Column(Text)
+    # TODO: Make brand a ForeignKey
+    brand = Column(Text, primary_key=True)
+    name = Column(Text, primary_key=True)
+    price = Column(Float)
+    description = Column(Text)
+    # TODO: Make type a ForeignKey
+    type = Column(Text)
+    image = Column(Text)
+    plant_type = Column(Text)
+    terpenes = Column(Text)
+
+    thc_low = Column(Integer)
+    thc_high = Column(Integer)
+    cbd_low = Column(Integer)
+    cbd_high = Column(Integer)
+
+    # For products sold without sizes; sizes are in history_availability.
+    # Older databases also have a price and availability column for each of
+    # sizes.LEGACY_SIZES, which are no longer written
+    standalone_price = Column(Integer)
+    standalone_availability = Column(Integer)
+
+
+class ProductListing(Base, ProductMixin):
+    __tablename__ = 'data'
+
+    __table_args__ = (
+        Index('ix_data_type', 'type'),
+    )
+
+
+class HistoricalListing(Base, ProductMixin):
+    __tablename__ = 'history'
+
+    timestamp = Column(Integer, primary_key=True)
+
+    __table_args__ = (
+        # The primary key leads with brand, so this is needed for finding a
+        # run's products (and their URLs) without scanning the whole table
+        Index('ix_history_timestamp_url', 'timestamp', 'url'),
+    )
+
+
+class HistoricalProductAvailability(Base):
+    # This table stores the availability data in way that allows for easier
+    # counting of remaining quantities
+
+    __tablename__ = 'history_availability'
+    timestamp = Column(Integer, nullable=False,primary_key=True)
+    brand = Column(Text, nullable=False, primary_key=True)
+    name = Column(Text, nullable=False, primary_key=True)
+    size = Column(Float, primary_key=True)
+    availability = Column(Integer)
+    # Filled in from the legacy size columns for older runs by sizes.py
+    price = Column(Integer)
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ['timestamp', 'brand', 'name'],
+            ['history.timestamp', 'history.brand', 'history.name']),
+        # Covers the SUM(size * availability) per product queries
+        Index('ix_history_availability_totals',
+              'timestamp', 'brand', 'name', 'size', 'availability'),
+    )
+
+
+class StagedListing(Base, ProductMixin):
+    # Products scraped by a run that hasn't finished yet.  The pipeline
+    # moves a run's rows into data and history once it finishes, so that
+    # those only ever have complete runs in them
+
+    __tablename__ = 'staging_listings'
+
+    timestamp = Column(Integer, primary_key=True)
+
+
+class StagedAvailability(Base):
+    __tablename__ = 'staging_availability'
+    timestamp = Column(Integer, primary_key=True)
+    brand = Column(Text, primary_key=True)
+    name = Column(Text, primary_key=True)
+    size = Column(Float, primary_key=True)
+    availability = Column(Integer)
+    price = Column(Integer)
+
+
+class ScrapeRun(Base):
+    # One row per scraping run, so the latest (finished) run can be found
+    # without sorting the distinct timestamps in history
+
+    __tablename__ = 'scrape_runs'
+    timestamp = Column(Integer, primary_key=True)
+    started_at = Column(Integer, nullable=False)
+    # NULL until the run has completed
+    finished_at = Column(Integer)
+    row_count = Column(Integer)
+
+    __table_args__ = (
+        Index('ix_scrape_runs_finished', 'timestamp',
+              sqlite_where=text('finished_at IS NOT NULL')),
+    )
+
+
+class SizeBackfillRun(Base):
+    # Runs that sizes.py has copied the legacy size columns from
+
+    __tablename__ = 'size_backfill_runs'
+    timestamp = Column(Integer, primary_key=True)
+
+
+class CrawlSummary(Base):
+    # How each run's crawl went: how long downloads took, and what failed
+
+    __tablename__ = 'crawl_summaries'
+    timestamp = Column(Integer, primary_key=True)
+    profile = Column(Text)
+    seconds = Column(Float)
+    request_count = Column(Integer)
+    response_count = Column(Integer)
+    retry_count = Column(Integer)
+    # Requests dropped after running out of retries
+    gave_up_count = Column(Integer)
+    error_count = Column(Integer)
+    # JSON object of error counts, by exception type or HTTP status
+    errors = Column(Text)
+    latency_p50 = Column(Float)
+    latency_p90 = Column(Float)
+    latency_p99 = Column(Float)
+    latency_max = Column(Float)
+
+
+class ScrapeMetric(Base):
+    # Counters and stage timings for each run, from metrics.py
+
+    __tablename__ = 'scrape_metrics'
+    timestamp = Column(Integer, primary_key=True)
+    name = Column(Text, primary_key=True)
+    # 'counter' (only count is set) or 'timer' (in seconds)
+    kind = Column(Text)
+    count = Column(Integer)
+    total = Column(Float)
+    min = Column(Float)
+    max = Column(Float)
+    # Upper bounds of the histogram buckets these fall in
+    p50 = Column(Float)
+    p90 = Column(Float)
+    p99 = Column(Float)
+
+
+class CrawlCacheEntry(Base):
+    # This table remembers what we saw for each product page last time, so
+    # unchanged pages can be skipped (or at least not re-parsed)
+
+    __tablename__ = 'crawl_cache'
+    url = Column(Text, primary_key=True)
+    etag = Column(Text)
+    last_modified = Column(Text)
+    content_length = Column(Integer)
+    body_hash = Column(Text)
+    result_hash = Column(Text)
+    result = Column(Text)
+
+
+class RunProductTotal(Base):
+    # Per-run stock totals, materialized by aggregates.py at the end of each
+    # run so the service and graphs don't have to re-aggregate history
+
+    __tablename__ = 'run_product_totals'
+    timestamp = Column(Integer, primary_key=True)
+    brand = Column(Text, primary_key=True)
+    name = Column(Text, primary_key=True)
+    # Grams available across all sizes
+    total = Column(Float)
+    # Units available, for products sold without sizes
+    units = Column(Integer)
+    combined_total = Column(Float)
+    # Change in combined_total since the previous run
+    delta = Column(Float)
+
+    __table_args__ = (
+        Index('ix_run_product_totals_combined_total',
+              'timestamp', 'combined_total'),
+    )
+
+
+class RunBrandTotal(Base):
+    __tablename__ = 'run_brand_totals'
+    timestamp = Column(Integer, primary_key=True)
+    brand = Column(Text, primary_key=True)
+    total = Column(Float)
+    units = Column(Integer)
+
+
+class RunTotal(Base):
+    __tablename__ = 'run_totals'
+    timestamp = Column(Integer, primary_key=True)
+    total = Column(Float)
+    units = Column(Integer)
+    product_count = Column(Integer)
+
+
+class Event(Base):
+    # What changed in each run since the previous one, found by events.py.
+    # kind is one of events.KINDS; size is set for changes to a single
+    # variant.  old_value and new_value are prices for 'price_change',
+    # availability for 'restocked' and combined totals for 'low_stock'; for
+    # 'sold', new_value is the estimated number sold (of size, if set)
+
+    __tablename__ = 'events'
+    id = Column(Integer, primary_key=True)
+    timestamp = Column(Integer, nullable=False)
+    kind = Column(Text, nullable=False)
+    brand = Column(Text, nullable=False)
+    name = Column(Text, nullable=False)
+    url = Column(Text)
+    size = Column(Float)
+    old_value = Column(Float)
+    new_value = Column(Float)
+
+    __table_args__ = (
+        Index('ix_events_kind_timestamp', 'kind', 'timestamp'),
+        Index('ix_events_product', 'kind', 'brand', 'name', 'timestamp'),
+    )
+
+
+class EventRun(Base):
+    # Runs that events.py has compared with their previous run, including
+    # those where nothing changed
+
+    __tablename__ = 'event_runs'
+    timestamp = Column(Integer, primary_key=True)
+    previous = Column(Integer)
+    event_count = Column(Integer)
+
+
+class GraphPoint(Base):
+    # Downsampled copies of the run totals, built incrementally by
+    # create_graphs.py: every point at 'raw' resolution, and the lowest and
+    # highest point in each bucket at 'hourly' and 'daily' resolution
+
+    __tablename__ = 'graph_points'
+    resolution = Column(Text, primary_key=True)
+    series = Column(Text, primary_key=True)
+    timestamp = Column(Integer, primary_key=True)
+    amount = Column(Float)
+
+    __table_args__ = (
+        Index('ix_graph_points_timestamp', 'resolution', 'timestamp'),
+    )
+
+
+def _set_wal_mode(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    # WAL is durable across application crashes with synchronous=NORMAL,
+    # and it saves an fsync per commit
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def _create_missing_indexes(engine):
+    # create_all only creates indexes along with their tables, so databases
+    # from before an index was added need it creating separately
+    inspector = inspect(engine)
+    table_names = inspector.get_table_names()
+    for table in Base.metadata.sorted_tables:
+        if table.name not in table_names:
+            # e.g. history is a view in normalized storage
+            continue
+        existing = {index['name']
+                    for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+
+
+def backfill_scrape_runs(session):
+    """Record runs from before scrape_runs existed, if it's empty."""
+    if session.query(ScrapeRun).first() is not None:
+        return
+    session.execute(
+        'INSERT INTO scrape_runs (timestamp, started_at, finished_at,'
+        ' row_count) SELECT timestamp, timestamp, timestamp, COUNT(*)'
+        ' FROM history GROUP BY timestamp')
+
+
+def _get_db_engine(path='data.sqlite', wal=False):
+    engine = create_engine('sqlite:///{}'.format(path))
+    if wal:
+        event.listen(engine, 'connect', _set_wal_mode)
+    Base.metadata.create_all(engine)
+    _create_missing_indexes(engine)
+    return engine
+
+
+def _get_db_session(path='data.sqlite'):
+    return sessionmaker(_get_db_engine(path))()
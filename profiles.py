@@ -0,0 +1,139 @@
+"""Named sets of Scrapy settings for crawling ocs.ca.
+
+    fast     as quickly as the site will serve us, for local testing
+    polite   one request at a time, backing off as the site slows down
+    nightly  the scheduled run: adaptive, and patient with failures
+
+Profiles can be overridden, or new ones added, with a JSON file mapping
+profile names to settings:
+
+    {"nightly": {"CONCURRENT_REQUESTS_PER_DOMAIN": 4}}
+"""
+import json
+
+from scrapy import signals
+from scrapy.downloadermiddlewares.retry import RetryMiddleware
+from scrapy.exceptions import DontCloseSpider, IgnoreRequest
+from twisted.internet import reactor
+
+
+DEFAULT_PROFILE = 'nightly'
+
+COMMON_SETTINGS = {
+    'DOWNLOADER_MIDDLEWARES': {
+        'scrapy.downloadermiddlewares.retry.RetryMiddleware': None,
+        '{}.BackoffRetryMiddleware'.format(__name__): 550,
+    },
+    # 429 is what the site sends when we're going too fast, so it's worth
+    # waiting and trying again rather than losing the product
+    'RETRY_HTTP_CODES': [500, 502, 503, 504, 522, 524, 408, 429],
+    'RETRY_BACKOFF_BASE': 1.0,
+    'RETRY_BACKOFF_MAX': 60.0,
+    # Every request is to the same host, so its address is only looked up
+    # once; connections to it are kept alive and reused, up to
+    # CONCURRENT_REQUESTS_PER_DOMAIN of them
+    'DNSCACHE_ENABLED': True,
+    'DNS_TIMEOUT': 20,
+}
+
+PROFILES = {
+    'fast': {
+        'CONCURRENT_REQUESTS': 32,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 16,
+        'DOWNLOAD_DELAY': 0,
+        'AUTOTHROTTLE_ENABLED': False,
+        'RETRY_TIMES': 2,
+        'DOWNLOAD_TIMEOUT': 20,
+    },
+    'polite': {
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 2,
+        'DOWNLOAD_DELAY': 1.0,
+        'AUTOTHROTTLE_ENABLED': True,
+        'AUTOTHROTTLE_START_DELAY': 1.0,
+        'AUTOTHROTTLE_MAX_DELAY': 30.0,
+        'AUTOTHROTTLE_TARGET_CONCURRENCY': 1.0,
+        'RETRY_TIMES': 5,
+        'RETRY_BACKOFF_BASE': 5.0,
+        'DOWNLOAD_TIMEOUT': 60,
+    },
+    'nightly': {
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 8,
+        'AUTOTHROTTLE_ENABLED': True,
+        'AUTOTHROTTLE_START_DELAY': 0.5,
+        'AUTOTHROTTLE_MAX_DELAY': 10.0,
+        'AUTOTHROTTLE_TARGET_CONCURRENCY': 4.0,
+        'RETRY_TIMES': 5,
+        'RETRY_BACKOFF_BASE': 2.0,
+        'DOWNLOAD_TIMEOUT': 30,
+    },
+}
+
+
+def get_settings(name=DEFAULT_PROFILE, config_path=None):
+    """Return the Scrapy settings for the named profile."""
+    profiles = {profile: dict(settings)
+                for profile, settings in PROFILES.items()}
+    if config_path is not None:
+        with open(config_path) as config_file:
+            for profile, settings in json.load(config_file).items():
+                profiles.setdefault(profile, {}).update(settings)
+    if name not in profiles:
+        raise ValueError('Unknown crawl profile {!r} (expected one of {})'
+                         .format(name, ', '.join(sorted(profiles))))
+    settings = dict(COMMON_SETTINGS)
+    settings.update(profiles[name])
+    settings['CRAWL_PROFILE'] = name
+    return settings
+
+
+class BackoffRetryMiddleware(RetryMiddleware):
+    """Retry like Scrapy's RetryMiddleware, waiting longer before each try.
+
+    The wait doubles from RETRY_BACKOFF_BASE seconds, up to
+    RETRY_BACKOFF_MAX.  A request waits outside the downloader, and is only
+    scheduled again once its wait is over, so it doesn't hold a
+    CONCURRENT_REQUESTS slot that other requests could use meanwhile.
+    """
+
+    def __init__(self, settings):
+        super(BackoffRetryMiddleware, self).__init__(settings)
+        self.backoff_base = settings.getfloat('RETRY_BACKOFF_BASE', 1.0)
+        self.backoff_max = settings.getfloat('RETRY_BACKOFF_MAX', 60.0)
+        self.crawler = None
+        # Retries waiting to be scheduled again
+        self.waiting = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = super(BackoffRetryMiddleware, cls).from_crawler(crawler)
+        # The engine is only created after its downloader's middlewares
+        middleware.crawler = crawler
+        crawler.signals.connect(
+            middleware.spider_idle, signal=signals.spider_idle)
+        return middleware
+
+    def _retry(self, request, reason, spider):
+        retry_request = super(BackoffRetryMiddleware, self)._retry(
+            request, reason, spider)
+        if retry_request is None:
+            return None
+        delay = min(self.backoff_max,
+                    self.backoff_base * 2 ** (retry_request.meta['retry_times']
+                                              - 1))
+        self.waiting.add(retry_request)
+        # Counted as in progress, so that closing the spider (e.g. on
+        # SIGTERM) waits for it to be scheduled, and saved with the job
+        self.crawler.engine.slot.add_request(retry_request)
+        reactor.callLater(delay, self._schedule, retry_request, spider)
+        raise IgnoreRequest('Retrying {} in {}s'.format(request, delay))
+
+    def _schedule(self, request, spider):
+        self.waiting.discard(request)
+        try:
+            self.crawler.engine.crawl(request, spider)
+        finally:
+            self.crawler.engine.slot.remove_request(request)
+
+    def spider_idle(self, spider):
+        if self.waiting:
+            raise DontCloseSpider()
@@ -1,129 +1,161 @@
-import csv
+#!/usr/bin/env python
+import argparse
+import collections
+import cProfile
 import datetime
+import hashlib
+import io
 import json
+import logging
+import math
+import multiprocessing
+import os
+import pstats
+import shutil
+import signal
 import time
+import traceback
 
-import scraperwiki
 import scrapy
+from scrapy import signals
 from scrapy.crawler import CrawlerProcess
-from slimit import ast
-from slimit.parser import Parser
-from slimit.visitors import nodevisitor
-from sqlalchemy import create_engine
-from sqlalchemy import (
-    Column, Float, ForeignKeyConstraint, Integer, Table, Text, and_, exists)
-from sqlalchemy.ext.declarative import declarative_base
+from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse
+from scrapy.utils.job import job_dir
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker
-
-
-Base = declarative_base()
-
-
-class ProductMixin(object):
-    sku = Column(Text)
-    url = Column(Text)
-    # TODO: Make brand a ForeignKey
-    brand = Column(Text, primary_key=True)
-    name = Column(Text, primary_key=True)
-    price = Column(Float)
-    description = Column(Text)
-    # TODO: Make type a ForeignKey
-    type = Column(Text)
-    image = Column(Text)
-    plant_type = Column(Text)
-    terpenes = Column(Text)
-
-    thc_low = Column(Integer)
-    thc_high = Column(Integer)
-    cbd_low = Column(Integer)
-    cbd_high = Column(Integer)
-
-    standalone_price = Column(Integer)
-    standalone_availability = Column(Integer)
-    _0_5g_price = Column('0.5g_price', Integer)
-    _0_5g_availability = Column('0.5g_availability', Integer)
-    _1g_price = Column('1g_price', Integer)
-    _1g_availability = Column('1g_availability', Integer)
-    _1_25g_price = Column('1.25g_price', Integer)
-    _1_25g_availability = Column('1.25g_availability', Integer)
-    _1_5g_price = Column('1.5g_price', Integer)
-    _1_5g_availability = Column('1.5g_availability', Integer)
-    _2_5g_price = Column('2.5g_price', Integer)
-    _2_5g_availability = Column('2.5g_availability', Integer)
-    _3_5g_price = Column('3.5g_price', Integer)
-    _3_5g_availability = Column('3.5g_availability', Integer)
-    _5g_price = Column('5g_price', Integer)
-    _5g_availability = Column('5g_availability', Integer)
-    _7g_price = Column('7g_price', Integer)
-    _7g_availability = Column('7g_availability', Integer)
-    _15g_price = Column('15g_price', Integer)
-    _15g_availability = Column('15g_availability', Integer)
-
-
-class ProductListing(Base, ProductMixin):
-    __tablename__ = 'data'
-
-
-class HistoricalListing(Base, ProductMixin):
-    __tablename__ = 'history'
-
-    timestamp = Column(Integer, primary_key=True)
-
-
-class HistoricalProductAvailability(Base):
-    # This table stores the availability data in way that allows for easier
-    # counting of remaining quantities
-
-    __tablename__ = 'history_availability'
-    timestamp = Column(Integer, nullable=False,primary_key=True)
-    brand = Column(Text, nullable=False, primary_key=True)
-    name = Column(Text, nullable=False, primary_key=True)
-    size = Column(Float, primary_key=True)
-    availability = Column(Integer)
-    # TODO: Backfill prices from history table
-    price = Column(Integer)
-
-    __table_args__ = (
-        ForeignKeyConstraint(
-            ['timestamp', 'brand', 'name'],
-            ['history.timestamp', 'history.brand', 'history.name']),
-    )
-
-
-def _get_db_session():
-    engine = create_engine('sqlite:///data.sqlite')
-    Base.metadata.create_all(engine)
-    return sessionmaker(engine)()
-
+from twisted.internet import defer, reactor
+from w3lib.url import add_or_replace_parameter, url_query_parameter
+
+import aggregates
+import events
+import history
+import profiles
+from metrics import Metrics
+from extract import (
+    extract_inventory_quantities, extract_variants, get_product_scripts)
+from models import (
+    CrawlCacheEntry, CrawlSummary, HistoricalListing,
+    HistoricalProductAvailability, ProductListing, ScrapeMetric, ScrapeRun,
+    StagedAvailability, StagedListing, _get_db_engine, _get_db_session,
+    backfill_scrape_runs)
+
+
+logger = logging.getLogger(__name__)
+
+
+def _dump_result(result):
+    # JSON can't have a None key, so store the variants as a list
+    result = dict(result)
+    result['variants'] = sorted(
+        [size, variant['price'], variant['availability']]
+        for size, variant in result['variants'].items())
+    return json.dumps(result, sort_keys=True)
+
+
+def _load_result(dumped):
+    result = json.loads(dumped)
+    result['variants'] = {
+        size: {'price': price, 'availability': availability}
+        for size, price, availability in result['variants']}
+    return result
+
+
+class CrawlCache(object):
+    """Validators and parsed results for product pages from previous runs."""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.dirty = {}
+        self.hits = {'304': 0, 'hash': 0}
+        self.misses = 0
+        self.unchanged = 0
+        self.bytes_saved = 0
+
+    @classmethod
+    def load(cls, session):
+        return cls({entry.url: entry
+                    for entry in session.query(CrawlCacheEntry)})
+
+    def request_headers(self, url):
+        entry = self.entries.get(url)
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def lookup(self, response):
+        """Return the cached result for response if the page is unchanged."""
+        entry = self.entries.get(response.url)
+        if entry is None:
+            self.misses += 1
+            return None
+        if response.status == 304:
+            self.hits['304'] += 1
+            self.bytes_saved += entry.content_length or 0
+            return _load_result(entry.result)
+        if hashlib.sha1(response.body).hexdigest() == entry.body_hash:
+            self.hits['hash'] += 1
+            self._update(entry, response)
+            return _load_result(entry.result)
+        self.misses += 1
+        return None
+
+    def _update(self, entry, response):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if (etag, last_modified) != (entry.etag, entry.last_modified):
+            entry.etag, entry.last_modified = etag, last_modified
+            self.dirty[entry.url] = entry
+
+    def store(self, response, result):
+        dumped = _dump_result(result)
+        result_hash = hashlib.sha1(dumped.encode('utf-8')).hexdigest()
+        entry = self.entries.get(response.url)
+        if entry is not None and entry.result_hash == result_hash:
+            self.unchanged += 1
+        self.entries[response.url] = self.dirty[response.url] = (
+            CrawlCacheEntry(
+                url=response.url,
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified'),
+                content_length=len(response.body),
+                body_hash=hashlib.sha1(response.body).hexdigest(),
+                result_hash=result_hash,
+                result=dumped,
+            ))
+
+    def save(self, session):
+        if not self.dirty:
+            return
+        rows = [{column.name: getattr(entry, column.name)
+                 for column in CrawlCacheEntry.__table__.columns}
+                for entry in self.dirty.values()]
+        session.execute(
+            CrawlCacheEntry.__table__.insert().prefix_with('OR REPLACE'),
+            rows)
+        self.dirty = {}
+
+    def hit_rate(self):
+        hits = sum(self.hits.values())
+        total = hits + self.misses
+        return float(hits) / total if total else 0.0
 
 
 TIMESTAMP = int(time.time())
 
 
-class OcsSpider(scrapy.Spider):
-    name = 'ocs'
-    allowed_domains = ['ocs.ca']
-    start_urls = ['https://ocs.ca/collections/all-cannabis-products']
-
-    def parse(self, response):
-        next_href = response.xpath(
-            './/li[@class="pagination_next"]/a/@href').extract_first()
-        for product_link in response.xpath(
-                './/article/div[1]/a[1]/@href').extract():
-            yield response.follow(
-                product_link, callback=self.parse_product_page)
-        if next_href is not None:
-            yield response.follow(next_href)
+def parse_product(response, metrics=None):
+    """Parse a product page into a plain result dict.
 
-    @property
-    def slimit_parser(self):
-        parser = getattr(self, '_slimit_parser', None)
-        if parser is None:
-            parser = Parser()
-            self._slimit_parser = parser
-        return parser
-
-    def parse_product_page(self, response):
+    The time spent in each stage is recorded in metrics, if given.
+    """
+    if metrics is None:
+        metrics = Metrics()
+    with metrics.timer('xpath'):
         result = {'url': response.url}
 
         # Header
@@ -159,89 +191,783 @@ class OcsSpider(scrapy.Spider):
         result['terpenes'] = response.xpath(
             './/p[@class="terpene__list"]/span/text()').extract()
 
-        shopify_script_content = response.xpath(
-            '//script[contains(text(), "var meta =")]/text()').extract_first()
-        tree = self.slimit_parser.parse(shopify_script_content)
-        for node in nodevisitor.visit(tree):
-            if node.to_ecma().startswith('"variants":'):
-                variants = json.loads(node.right.to_ecma())
-                break
+        shopify_script_content, inventory_script_content = (
+            get_product_scripts(response))
+    with metrics.timer('variant parsing'):
+        variants = extract_variants(shopify_script_content)
+    variant_dict = {
+        d['id']: {'size': d['public_title'], 'price': d['price']}
+        for d in variants}
+
+    with metrics.timer('inventory parsing'):
+        inventory_quantities = extract_inventory_quantities(
+            inventory_script_content)
+    for id_, quantity in inventory_quantities.items():
+        if id_ not in variant_dict:
+            raise Exception('{} not in {}'.format(id_, variant_dict))
+        variant_dict[id_]['availability'] = quantity
+    result['variants'] = {
+        variant['size']: {'price': variant['price'],
+                          'availability': variant['availability']}
+        for variant in variant_dict.values()
+    }
+
+    if result['url'] == 'https://ocs.ca/products/great-white-shark-2':
+        # Fixup a duplicate name in the OCS site
+        result['name'] = 'Mazar x G.W.S.'
+
+    # TODO: GTIN
+    metrics.inc('products parsed')
+    metrics.inc('variants parsed', len(result['variants']))
+    logger.debug('Parsed product url=%s brand=%r name=%r variants=%d',
+                 result['url'], result['brand'], result['name'],
+                 len(result['variants']))
+    return result
+
+
+def _ignore_sigint():
+    # Leave Ctrl-C to the crawl, which will close the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _parse_in_worker(url, body, encoding):
+    # Runs in a parse pool process; exceptions don't survive the trip back
+    # to the crawl on Python 2, so they are returned as text
+    try:
+        response = HtmlResponse(url, body=body, encoding=encoding)
+        metrics = Metrics()
+        return True, (parse_product(response, metrics), metrics)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+class OcsSpider(scrapy.Spider):
+    name = 'ocs'
+    allowed_domains = ['ocs.ca']
+    start_urls = ['https://ocs.ca/collections/all-cannabis-products']
+    crawl_cache = None
+    parse_pool = None
+    profiler = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(OcsSpider, cls).from_crawler(crawler, *args, **kwargs)
+        spider.started = time.time()
+        spider.metrics = Metrics()
+        crawler.signals.connect(
+            spider.record_download, signal=signals.response_received)
+        spider.pagination_fan_out = crawler.settings.getbool(
+            'PAGINATION_FAN_OUT', True)
+        if crawler.settings.getbool('CRAWL_CACHE_ENABLED', True):
+            session = _get_db_session(
+                crawler.settings.get('SQLITE_PATH', 'data.sqlite'))
+            spider.crawl_cache = CrawlCache.load(session)
+            session.close()
+            crawler.signals.connect(
+                spider.log_crawl_cache, signal=signals.spider_closed)
+        workers = crawler.settings.getint('PARSE_WORKERS', 0)
+        if workers > 0:
+            spider.parse_pool = multiprocessing.Pool(
+                workers, initializer=_ignore_sigint)
+            # Results from the pool, in the order their pages were received
+            spider.parse_queue = collections.deque()
+            crawler.signals.connect(
+                spider.close_parse_pool, signal=signals.spider_closed)
+        spider.profile_pages = crawler.settings.getint('PROFILE_PAGES', 0)
+        if spider.profile_pages > 0:
+            if spider.parse_pool is not None:
+                spider.logger.warning(
+                    'PROFILE_PAGES is ignored when parsing in a pool')
+            else:
+                spider.profiler = cProfile.Profile()
+                spider.profile_output = crawler.settings.get(
+                    'PROFILE_OUTPUT', 'scrape.prof')
+                crawler.signals.connect(
+                    spider.save_profile, signal=signals.spider_closed)
+        return spider
+
+    def record_download(self, response, request, spider):
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.metrics.observe('download', latency)
+        self.metrics.inc('responses')
+
+    def save_profile(self, spider):
+        self.profiler.dump_stats(self.profile_output)
+        output = io.BytesIO()
+        stats = pstats.Stats(self.profiler, stream=output)
+        stats.sort_stats('cumulative').print_stats(15)
+        self.logger.info('Profile of %d product pages saved to %s:\n%s',
+                         self.metrics.counters.get('pages profiled', 0),
+                         self.profile_output, output.getvalue())
+
+    def close_parse_pool(self, spider):
+        self.parse_pool.close()
+        self.parse_pool.join()
+
+    def log_crawl_cache(self, spider):
+        cache = self.crawl_cache
+        for key, value in [('hits/304', cache.hits['304']),
+                           ('hits/hash', cache.hits['hash']),
+                           ('misses', cache.misses),
+                           ('unchanged', cache.unchanged),
+                           ('bytes_saved', cache.bytes_saved)]:
+            self.crawler.stats.set_value('crawl_cache/' + key, value)
+        self.logger.info(
+            'Crawl cache: %.1f%% hit rate (%d not modified, %d same content,'
+            ' %d misses), %d bytes saved',
+            cache.hit_rate() * 100, cache.hits['304'], cache.hits['hash'],
+            cache.misses, cache.bytes_saved)
+
+    def _last_page(self, response):
+        # The numbered links in the pagination, if they still look like
+        # ?page=N links to the same collection
+        pages = []
+        for link in response.xpath('.//ul[@class="pagination"]//a'):
+            number = link.xpath('normalize-space(text())').extract_first()
+            url = response.urljoin(link.xpath('@href').extract_first() or '')
+            if number.isdigit() and url_query_parameter(url, 'page') == number:
+                pages.append(int(number))
+        return max(pages) if pages else None
+
+    def parse(self, response):
+        next_href = response.xpath(
+            './/li[@class="pagination_next"]/a/@href').extract_first()
+        for product_link in response.xpath(
+                './/article/div[1]/a[1]/@href').extract():
+            headers = {}
+            if self.crawl_cache is not None:
+                headers = self.crawl_cache.request_headers(
+                    response.urljoin(product_link))
+            yield response.follow(
+                product_link, callback=self.parse_product_page,
+                headers=headers, meta={'handle_httpstatus_list': [304]})
+
+        stats = self.crawler.stats
+        if self.pagination_fan_out and 'listing_page' not in response.meta:
+            # Queue every listing page at once, rather than discovering them
+            # one page load at a time
+            last_page = self._last_page(response)
+            if last_page is None:
+                stats.inc_value('pagination/serial_fallback')
+            else:
+                stats.set_value('pagination/pages_queued', last_page - 1)
+                for page in range(2, last_page + 1):
+                    yield response.follow(
+                        add_or_replace_parameter(
+                            response.url, 'page', str(page)),
+                        meta={'listing_page': page}, priority=1)
+        # Also walk the next links: any pages already queued are dropped as
+        # duplicates, and this finds any beyond the last numbered link
+        if next_href is not None:
+            yield response.follow(
+                next_href, meta={'listing_page': None}, priority=1)
+        stats.max_value('pagination/discovery_seconds',
+                        time.time() - self.started)
+
+    def parse_product_page(self, response):
+        if self.crawl_cache is not None:
+            cached = self.crawl_cache.lookup(response)
+            if cached is not None:
+                if self.parse_pool is not None:
+                    return self._queue_cached(response, cached)
+                return [cached]
+            if response.status == 304:
+                self.logger.warning(
+                    'Not modified but not in crawl cache: %s', response.url)
+                return []
+        if self.parse_pool is not None:
+            return self._parse_in_pool(response)
+        if (self.profiler is not None
+                and self.metrics.counters.get('pages profiled', 0)
+                < self.profile_pages):
+            self.metrics.inc('pages profiled')
+            self.profiler.enable()
+            try:
+                result = parse_product(response, self.metrics)
+            finally:
+                self.profiler.disable()
         else:
-            raise Exception('No variants found')
-        variant_dict = {
-            d['id']: {'size': d['public_title'], 'price': d['price']}
-            for d in variants}
-
-        inventory_script_content = response.xpath(
-            '//script[contains(text(), "var inventory_quantities =")]'
-            '/text()').extract_first()
-        # slimit chokes on the full content, so just use the line we care about
-        inventory_quantities_line = (line for line in inventory_script_content.splitlines() if 'var inventory_quantities' in line).next()
-        tree = self.slimit_parser.parse(inventory_quantities_line)
-        for node in nodevisitor.visit(tree):
-            if node.to_ecma().startswith('inventory_quantities ='):
-                # This gets us inventory_quantities = {...}; the {...} uses
-                # integer keys, so we can't just json.loads it; pull out the
-                # values explicitly instead
-                for assign in node.initializer.children():
-                    id_, quantity = (
-                        int(assign.left.to_ecma()), int(assign.right.to_ecma()))
-                    if id_ not in variant_dict:
-                        raise Exception(
-                            '{} not in {}'.format(id_, variant_dict))
-                    variant_dict[id_]['availability'] = quantity
-        result['variants'] = {
-            variant['size']: {'price': variant['price'],
-                              'availability': variant['availability']}
-            for variant in variant_dict.values()
-        }
-
-        if result['url'] == 'https://ocs.ca/products/great-white-shark-2':
-            # Fixup a duplicate name in the OCS site
-            result['name'] = 'Mazar x G.W.S.'
-
-        # TODO: GTIN
-        print(result)
-
-        # Copy over data that is directly supported in SQLite
-        sqlite_data = {
-            k: v for k, v in result.items()
-            if k in ['url', 'brand', 'name', 'sku', 'price', 'description',
-                     'type', 'plant_type', 'image']}
-        for range_type in ['thc', 'cbd']:
-            low, high = result['{}_range'.format(range_type)]
-            sqlite_data['{}_low'.format(range_type)] = low
-            sqlite_data['{}_high'.format(range_type)] = high
-        sqlite_data['terpenes'] = ','.join(result['terpenes'])
-
-        session = _get_db_session()
-
-        for size, variant_dict in result['variants'].items():
-            if size is None:
-                prefix = 'standalone_'
+            result = parse_product(response, self.metrics)
+        return [self._parsed(response, result)]
+
+    def _parsed(self, response, result):
+        if self.crawl_cache is not None:
+            self.crawl_cache.store(response, result)
+        return result
+
+    def _parse_in_pool(self, response):
+        # Hand the page to the pool and return a Deferred, which Scrapy
+        # waits on without blocking the reactor
+        entry = {'response': response, 'outcome': None,
+                 'deferred': defer.Deferred()}
+        self.parse_queue.append(entry)
+
+        def done(outcome):
+            # Called on the pool's result thread
+            reactor.callFromThread(self._release_parsed, entry, outcome)
+
+        self.parse_pool.apply_async(
+            _parse_in_worker,
+            (response.url, response.body, response.encoding),
+            callback=done)
+        return entry['deferred']
+
+    def _queue_cached(self, response, result):
+        # Cache hits wait behind the pages still in the pool too, or they
+        # would overtake them (and the pipeline keeps the first product
+        # with a given brand and name)
+        entry = {'response': response, 'outcome': None,
+                 'deferred': defer.Deferred()}
+        self.parse_queue.append(entry)
+        self._release_parsed(entry, (True, (result, None)))
+        return entry['deferred']
+
+    def _release_parsed(self, entry, outcome):
+        entry['outcome'] = outcome
+        # Hold results back until every page received before them is
+        # parsed, so items reach the pipeline in the same order as when
+        # parsing in-process
+        while self.parse_queue and self.parse_queue[0]['outcome']:
+            entry = self.parse_queue.popleft()
+            succeeded, value = entry['outcome']
+            if succeeded:
+                result, metrics = value
+                # No metrics for a crawl cache hit, which is already cached
+                if metrics is not None:
+                    self.metrics.merge(metrics)
+                    result = self._parsed(entry['response'], result)
+                entry['deferred'].callback([result])
             else:
-                prefix = '_{}_'.format(size.replace('.', '_'))
-            if size in ['0.5g', '1g', '1.25g', '1.5g', '2.5g', '3.5g', '5g',
-                        '7g', '15g', None]:
-                # Only populate the legacy sizes
-                sqlite_data[prefix + 'price'] = variant_dict['price']
-                sqlite_data[prefix + 'availability'] = (
-                    variant_dict['availability'])
-            if size is not None:
-                session.add(HistoricalProductAvailability(
-                    timestamp=TIMESTAMP,
-                    brand=result['brand'],
-                    name=result['name'],
-                    size=float(size.strip('g')),
-                    availability=int(variant_dict['availability']),
-                    price=int(variant_dict['price']),
-                ))
-
-        session.add(ProductListing(**sqlite_data))
-
-        sqlite_data['timestamp'] = TIMESTAMP
-        session.add(HistoricalListing(**sqlite_data))
+                entry['deferred'].errback(Exception(
+                    'Parsing {} failed:\n{}'.format(
+                        entry['response'].url, value)))
+
+
+def _result_to_rows(result, timestamp):
+    """Convert a parsed product page into (listing, availability) rows.
+
+    The listing row is for the staging_listings table, and the availability
+    rows are for staging_availability; see SqlitePipeline.
+    """
+    # Copy over data that is directly supported in SQLite
+    sqlite_data = {
+        k: v for k, v in result.items()
+        if k in ['url', 'brand', 'name', 'sku', 'price', 'description',
+                 'type', 'plant_type', 'image']}
+    for range_type in ['thc', 'cbd']:
+        low, high = result['{}_range'.format(range_type)]
+        sqlite_data['{}_low'.format(range_type)] = low
+        sqlite_data['{}_high'.format(range_type)] = high
+    sqlite_data['terpenes'] = ','.join(result['terpenes'])
+
+    availability_rows = []
+    for size, variant_dict in result['variants'].items():
+        if size is None:
+            sqlite_data['standalone_price'] = variant_dict['price']
+            sqlite_data['standalone_availability'] = (
+                variant_dict['availability'])
+        else:
+            availability_rows.append({
+                'timestamp': timestamp,
+                'brand': result['brand'],
+                'name': result['name'],
+                'size': float(size.strip('g')),
+                'availability': int(variant_dict['availability']),
+                'price': int(variant_dict['price']),
+            })
+
+    sqlite_data['timestamp'] = timestamp
+    return sqlite_data, availability_rows
+
+
+def _run_timestamp(settings):
+    """Return the timestamp of the run this crawl adds to.
+
+    With JOBDIR set, it is saved there when the run starts, so a crawl
+    resumed from JOBDIR carries on with the same run.
+    """
+    jobdir = job_dir(settings)
+    if not jobdir:
+        return TIMESTAMP
+    path = os.path.join(jobdir, 'run_timestamp')
+    if not os.path.exists(path):
+        with open(path, 'w') as run_file:
+            run_file.write(str(TIMESTAMP))
+    with open(path) as run_file:
+        return int(run_file.read())
+
+
+class CrawlJobExtension(object):
+    """Start a new run in JOBDIR, unless it has one that can be resumed.
+
+    Scrapy keeps the request queue and the requests already seen in JOBDIR,
+    and saves the queue's state when the crawl stops.  A run can only be
+    resumed if its crawl stopped that way before reaching the end (e.g.
+    after a SIGTERM).  Once a crawl has reached the end, every product is in
+    the requests seen, so resuming it would fetch nothing; if its run wasn't
+    published, it has to start again.
+    """
+
+    def __init__(self, jobdir, path):
+        self.jobdir = jobdir
+        # Written when a crawl stops before reaching the end
+        self.resumable_path = os.path.join(jobdir, 'resumable')
+        self.discard_finished_job(path)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        jobdir = crawler.settings.get('JOBDIR')
+        if not jobdir:
+            raise NotConfigured
+        extension = cls(jobdir,
+                        crawler.settings.get('SQLITE_PATH', 'data.sqlite'))
+        crawler.signals.connect(
+            extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(
+            extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def discard_finished_job(self, path):
+        run_path = os.path.join(self.jobdir, 'run_timestamp')
+        if not os.path.exists(run_path):
+            return
+        with open(run_path) as run_file:
+            timestamp = int(run_file.read())
+        session = _get_db_session(path)
+        run = session.query(ScrapeRun).get(timestamp)
+        session.close()
+        if run is not None and run.finished_at is not None:
+            reason = 'has already finished'
+        elif not os.path.exists(self.resumable_path):
+            # Either the crawl was killed before Scrapy could save its queue,
+            # or it reached the end but the run couldn't be published
+            reason = "can't be resumed"
+        else:
+            logger.info('Resuming run %d from %s', timestamp, self.jobdir)
+            return
+        logger.warning('Run %d in %s %s; starting a new one',
+                       timestamp, self.jobdir, reason)
+        shutil.rmtree(self.jobdir)
+
+    def spider_opened(self, spider):
+        if os.path.exists(self.resumable_path):
+            os.remove(self.resumable_path)
+
+    def spider_closed(self, spider, reason):
+        # The scheduler has saved the queue by now
+        if reason != 'finished':
+            with open(self.resumable_path, 'w') as resumable_file:
+                resumable_file.write(reason)
+
+
+LISTING_COLUMNS = [column.name for column in ProductListing.__table__.columns]
+
+PUBLISH_LISTINGS = (
+    'INSERT INTO {table} ({columns}) SELECT {columns} FROM staging_listings'
+    ' WHERE timestamp = :timestamp')
+
+PUBLISH_AVAILABILITY = (
+    'INSERT INTO history_availability'
+    ' (timestamp, brand, name, size, availability, price)'
+    ' SELECT timestamp, brand, name, size, availability, price'
+    ' FROM staging_availability WHERE timestamp = :timestamp')
+
+
+class SqlitePipeline(object):
+    """Write parsed products to SQLite in batches.
+
+    A single engine and session are used for the whole crawl; rows are
+    buffered and written to the staging tables with executemany once
+    SQLITE_BATCH_SIZE products have been collected (and once more when the
+    spider closes).  When the run finishes, its rows are moved from staging
+    into data and history in the same transaction that marks it as
+    finished, so an interrupted run is never seen there; a crawl resumed
+    from JOBDIR keeps adding to its staged rows.  A crawl that found no
+    products, or that gave up on (or failed to parse) more than
+    SQLITE_MAX_FAILED_FRACTION of its pages, leaves its run unfinished too.
+
+    HISTORY_STORAGE picks how history is stored: 'wide' (the history and
+    history_availability tables) or 'normalized' (see history.py).  By
+    default, a database that has been converted to normalized storage keeps
+    being written that way.
+    """
+
+    def __init__(self, path, batch_size, stats=None, history_storage=None,
+                 timestamp=TIMESTAMP, max_failed_fraction=0.05):
+        self.path = path
+        self.batch_size = batch_size
+        self.max_failed_fraction = max_failed_fraction
+        self.stats = stats
+        self.history_storage = history_storage
+        self.timestamp = timestamp
+        self.session = None
+        self.snapshots = None
+        self._listings = []
+        self._availabilities = []
+        # (brand, name) of the products already in this run
+        self._keys = set()
+        self._uncommitted = {}
+        self.rows_written = {}
+        self.flush_count = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls(
+            crawler.settings.get('SQLITE_PATH', 'data.sqlite'),
+            crawler.settings.getint('SQLITE_BATCH_SIZE', 250),
+            stats=crawler.stats,
+            history_storage=crawler.settings.get('HISTORY_STORAGE'),
+            timestamp=_run_timestamp(crawler.settings),
+            max_failed_fraction=crawler.settings.getfloat(
+                'SQLITE_MAX_FAILED_FRACTION', 0.05),
+        )
+        crawler.signals.connect(
+            pipeline.spider_closed, signal=signals.spider_closed)
+        return pipeline
+
+    def open_spider(self, spider):
+        self.engine = _get_db_engine(self.path, wal=True)
+        self.session = sessionmaker(self.engine)()
+        storage = self.history_storage
+        if storage is None:
+            storage = ('normalized' if history.is_normalized(self.engine)
+                       else 'wide')
+        if storage == 'normalized':
+            history.create_schema(self.engine)
+            self.snapshots = history.SnapshotWriter(self.session)
+        elif storage != 'wide':
+            raise Exception('Unknown HISTORY_STORAGE: {}'.format(storage))
+        backfill_scrape_runs(self.session)
+        run = self.session.query(ScrapeRun).get(self.timestamp)
+        if run is None:
+            self.session.add(ScrapeRun(timestamp=self.timestamp,
+                                       started_at=int(time.time())))
+        elif run.finished_at is not None:
+            raise Exception('Run {} has already finished'.format(
+                self.timestamp))
+        else:
+            spider.logger.info('Adding to unfinished run %d', self.timestamp)
+        # Rows staged by runs that were abandoned
+        for model in [StagedListing, StagedAvailability]:
+            self.session.query(model).filter(
+                model.timestamp != self.timestamp).delete()
+        self.session.commit()
+        self._keys = set(self.session.query(
+            StagedListing.brand, StagedListing.name).filter_by(
+                timestamp=self.timestamp))
+
+    def process_item(self, item, spider):
+        key = (item['brand'], item['name'])
+        if key in self._keys:
+            # The site has listed two products under one name before; the
+            # first is kept, as (brand, name) is the key of every table
+            logger.warning('Skipping duplicate product %s %s: %s',
+                           key[0], key[1], item.get('url'))
+            if self.stats is not None:
+                self.stats.inc_value('sqlite/duplicates')
+            return item
+        self._keys.add(key)
+        listing, availabilities = _result_to_rows(item, self.timestamp)
+        self._listings.append(listing)
+        self._availabilities.extend(availabilities)
+        if len(self._listings) >= self.batch_size:
+            self.flush(spider)
+        return item
+
+    def _record_rows(self, table, count):
+        # Counted once the transaction they're written in commits
+        self._uncommitted[table] = self._uncommitted.get(table, 0) + count
+
+    def _commit(self):
+        self.session.commit()
+        for table, count in self._uncommitted.items():
+            self.rows_written[table] = self.rows_written.get(table, 0) + count
+            if self.stats is not None:
+                self.stats.inc_value(
+                    'sqlite/rows_written/{}'.format(table), count)
+        self._uncommitted = {}
+
+    def _rollback(self):
+        self.session.rollback()
+        self._uncommitted = {}
+
+    def _stage(self, listings, availabilities):
+        for model, rows in [(StagedListing, listings),
+                            (StagedAvailability, availabilities)]:
+            if rows:
+                self.session.bulk_insert_mappings(model, rows)
+                self._record_rows(model.__tablename__, len(rows))
+
+    def _stage_one_at_a_time(self):
+        availabilities = collections.defaultdict(list)
+        for row in self._availabilities:
+            availabilities[(row['brand'], row['name'])].append(row)
+        for listing in self._listings:
+            key = (listing['brand'], listing['name'])
+            try:
+                self._stage([listing], availabilities[key])
+                self._commit()
+            except SQLAlchemyError:
+                self._rollback()
+                logger.exception('Dropped product %s %s', *key)
+                if self.stats is not None:
+                    self.stats.inc_value('sqlite/products_dropped')
+
+    def _stage_batch(self, spider):
+        try:
+            self._stage(self._listings, self._availabilities)
+            self._save_crawl_cache(spider)
+            self._commit()
+        except SQLAlchemyError:
+            self._rollback()
+            logger.warning(
+                'Writing a batch of %d products failed; writing them one at'
+                ' a time', len(self._listings), exc_info=True)
+            if self.stats is not None:
+                self.stats.inc_value('sqlite/failed_batches')
+            self._stage_one_at_a_time()
+            try:
+                self._save_crawl_cache(spider)
+                self._commit()
+            except SQLAlchemyError:
+                self._rollback()
+                logger.exception('Saving the crawl cache failed')
+
+    def _save_crawl_cache(self, spider):
+        cache = getattr(spider, 'crawl_cache', None)
+        if cache is not None:
+            cache.save(self.session)
+
+    def _publish_snapshots(self):
+        availability = collections.defaultdict(list)
+        for brand, name, size, price, quantity in self.session.execute(
+                'SELECT brand, name, size, price, availability'
+                ' FROM staging_availability WHERE timestamp = :timestamp',
+                {'timestamp': self.timestamp}):
+            availability[(brand, name)].append(
+                {'size': size, 'price': price, 'availability': quantity})
+        listings = self.session.execute(
+            'SELECT {} FROM staging_listings WHERE timestamp = :timestamp'
+            .format(', '.join(LISTING_COLUMNS)),
+            {'timestamp': self.timestamp}).fetchall()
+        for count, row in enumerate(listings, 1):
+            listing = dict(zip(LISTING_COLUMNS, row))
+            self.snapshots.add(
+                self.timestamp, listing,
+                availability.get((listing['brand'], listing['name']), []))
+            if count % self.batch_size == 0:
+                for table, written in self.snapshots.flush().items():
+                    self._record_rows(table, written)
+        for table, written in self.snapshots.finish_run(
+                self.timestamp).items():
+            self._record_rows(table, written)
+
+    def _publish(self):
+        """Move the run's staged rows into data and history."""
+        params = {'timestamp': self.timestamp}
+        columns = ', '.join(LISTING_COLUMNS)
+        # data only contains the latest finished run
+        self.session.execute('DELETE FROM data')
+        row_count = self.session.execute(PUBLISH_LISTINGS.format(
+            table='data', columns=columns), params).rowcount
+        self._record_rows(ProductListing.__tablename__, row_count)
+        if self.snapshots is not None:
+            self._publish_snapshots()
+        else:
+            self._record_rows(
+                HistoricalListing.__tablename__,
+                self.session.execute(PUBLISH_LISTINGS.format(
+                    table='history', columns=columns + ', timestamp'),
+                    params).rowcount)
+            self._record_rows(
+                HistoricalProductAvailability.__tablename__,
+                self.session.execute(PUBLISH_AVAILABILITY, params).rowcount)
+        for model in [StagedListing, StagedAvailability]:
+            self.session.query(model).filter_by(
+                timestamp=self.timestamp).delete()
+        return row_count
+
+    def _failure_count(self):
+        """Return how many pages were given up on or failed to parse."""
+        if self.stats is None:
+            return 0
+        stats = self.stats.get_stats()
+        return stats.get('retry/max_reached', 0) + sum(
+            value for key, value in stats.items()
+            if key.startswith('spider_exceptions/'))
+
+    def _is_complete(self):
+        """Return whether the run found enough products to publish."""
+        row_count = self.session.query(StagedListing).filter_by(
+            timestamp=self.timestamp).count()
+        failures = self._failure_count()
+        if row_count and (
+                failures <= self.max_failed_fraction * (row_count + failures)):
+            return True
+        # Publishing it would replace data with a partial run, and have
+        # events record the missing products as delisted
+        logger.warning(
+            'Run %d found %d products, and gave up on or failed to parse %d'
+            ' pages; it is left unfinished, and its products in staging',
+            self.timestamp, row_count, failures)
+        return False
+
+    def _finish_run(self):
+        """Publish the run; returns whether it was."""
+        if not self._is_complete():
+            return False
+        try:
+            row_count = self._publish()
+            aggregates.materialize(self.session, self.timestamp)
+            run_events = events.detect(self.session, self.timestamp)
+            self.session.query(ScrapeRun).filter_by(
+                timestamp=self.timestamp).update({
+                    'finished_at': int(time.time()),
+                    'row_count': row_count,
+                })
+            self._commit()
+        except SQLAlchemyError:
+            self._rollback()
+            logger.exception(
+                'Publishing run %d failed; it is left unfinished, and its'
+                ' products in staging', self.timestamp)
+            return False
+        if self.stats is not None:
+            for kind, count in run_events.items():
+                self.stats.set_value('events/{}'.format(kind), count)
+        return True
+
+    def flush(self, spider=None, finish_run=False):
+        """Write the buffered products, and publish the run if finish_run.
+
+        A batch that can't be written is retried a product at a time, so
+        only the products that can't be written are lost.  Returns whether
+        the run was published.
+        """
+        if not (self._listings or self._availabilities or finish_run):
+            return False
+        start = time.time()
+        product_count = len(self._listings)
+        try:
+            if self._listings:
+                self._stage_batch(spider)
+        finally:
+            self._listings = []
+            self._availabilities = []
+        published = finish_run and self._finish_run()
+        elapsed = time.time() - start
+        if spider is not None:
+            spider.metrics.observe('db write', elapsed)
+        self.flush_count += 1
+        self.flush_seconds += elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        if self.stats is not None:
+            self.stats.inc_value('sqlite/flush_count')
+            self.stats.set_value('sqlite/flush_seconds', self.flush_seconds)
+            self.stats.max_value('sqlite/max_flush_seconds', elapsed)
+        logger.debug('Flushed %d products in %.3fs', product_count, elapsed)
+        return published
+
+    def spider_closed(self, spider, reason):
+        if self.session is None:
+            return
+        # Only a run that got to the end is marked as finished
+        self.flush(spider, finish_run=(reason == 'finished'))
+        # A resumed run's metrics only cover the crawl that finished it
+        self.session.query(ScrapeMetric).filter_by(
+            timestamp=self.timestamp).delete()
+        self.session.bulk_insert_mappings(
+            ScrapeMetric, spider.metrics.rows(self.timestamp))
+        self._commit()
+        spider.metrics.log(spider.logger)
+        self.session.close()
+        self.engine.dispose()
+        self.session = None
+        spider.logger.info(
+            'Wrote %s in %d flushes (%.3fs total, %.3fs max)',
+            self.rows_written, self.flush_count, self.flush_seconds,
+            self.max_flush_seconds)
+
+
+def _percentile(values, percent):
+    # Nearest-rank, on already sorted values
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+
+class CrawlSummaryExtension(object):
+    """Record each run's download latencies and errors in crawl_summaries."""
+
+    def __init__(self, path, profile, stats, timestamp=TIMESTAMP):
+        self.path = path
+        self.profile = profile
+        self.stats = stats
+        self.timestamp = timestamp
+        self.latencies = []
+        self.start = time.time()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        extension = cls(crawler.settings.get('SQLITE_PATH', 'data.sqlite'),
+                        crawler.settings.get('CRAWL_PROFILE'),
+                        crawler.stats, _run_timestamp(crawler.settings))
+        crawler.signals.connect(
+            extension.response_received, signal=signals.response_received)
+        crawler.signals.connect(
+            extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def response_received(self, response, request, spider):
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.latencies.append(latency)
+
+    def _errors(self):
+        errors = {}
+        for key, value in self.stats.get_stats().items():
+            if key.startswith('downloader/exception_type_count/'):
+                errors[key.rsplit('/', 1)[1]] = value
+            elif key.startswith('downloader/response_status_count/'):
+                status = key.rsplit('/', 1)[1]
+                if int(status) >= 400:
+                    errors['HTTP {}'.format(status)] = value
+            elif key.startswith('spider_exceptions/'):
+                errors[key.split('/', 1)[1]] = value
+        return errors
+
+    def spider_closed(self, spider, reason):
+        latencies = sorted(self.latencies)
+        errors = self._errors()
+        summary = CrawlSummary(
+            timestamp=self.timestamp,
+            profile=self.profile,
+            seconds=time.time() - self.start,
+            request_count=self.stats.get_value('downloader/request_count', 0),
+            response_count=self.stats.get_value(
+                'downloader/response_count', 0),
+            retry_count=self.stats.get_value('retry/count', 0),
+            gave_up_count=self.stats.get_value('retry/max_reached', 0),
+            error_count=sum(errors.values()),
+            errors=json.dumps(errors, sort_keys=True),
+            latency_p50=_percentile(latencies, 50),
+            latency_p90=_percentile(latencies, 90),
+            latency_p99=_percentile(latencies, 99),
+            latency_max=latencies[-1] if latencies else None,
+        )
+        session = _get_db_session(self.path)
+        session.merge(summary)
         session.commit()
+        session.close()
+        spider.logger.info(
+            'Crawl summary (%s profile): %d requests, %d retries, %d given'
+            ' up, %d errors %s; latency p50=%s p90=%s p99=%s',
+            summary.profile, summary.request_count, summary.retry_count,
+            summary.gave_up_count, summary.error_count, summary.errors,
+            summary.latency_p50, summary.latency_p90, summary.latency_p99)
 
 
 def do_fixups():
@@ -249,13 +975,42 @@ def do_fixups():
 
 
 if __name__ == '__main__':
-    do_fixups()
-    # data should only contain the data from the latest run
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--profile', help='crawl profile (default: {})'.format(
+            profiles.DEFAULT_PROFILE),
+        default=os.environ.get('MORPH_CRAWL_PROFILE',
+                               profiles.DEFAULT_PROFILE))
+    parser.add_argument('--config', help='JSON file of crawl profiles',
+                        default=os.environ.get('MORPH_CRAWL_CONFIG'))
+    parser.add_argument('--log-level', default='INFO',
+                        help='DEBUG logs every product parsed')
+    parser.add_argument('--profile-pages', type=int, default=0, metavar='N',
+                        help='profile parsing the first N product pages')
+    parser.add_argument('--jobdir',
+                        default=os.environ.get('MORPH_CRAWL_JOBDIR',
+                                               'crawl-job'),
+                        help='where to save the crawl\'s progress, so that an'
+                        ' interrupted crawl can be resumed ("" to disable)')
+    args = parser.parse_args()
     try:
-        scraperwiki.sqlite.execute('DROP TABLE data')
-    except Exception as exc:
-        if 'no such table' not in str(exc):
-            raise
-    process = CrawlerProcess()
+        settings = profiles.get_settings(args.profile, args.config)
+    except ValueError as exc:
+        parser.error(str(exc))
+    settings['LOG_LEVEL'] = args.log_level
+    settings['PROFILE_PAGES'] = args.profile_pages
+
+    do_fixups()
+    settings.update({
+        'ITEM_PIPELINES': {'{}.SqlitePipeline'.format(__name__): 300},
+        'EXTENSIONS': {
+            # Before CrawlSummaryExtension, which needs the run's timestamp
+            '{}.CrawlJobExtension'.format(__name__): 100,
+            '{}.CrawlSummaryExtension'.format(__name__): 500,
+        },
+    })
+    if args.jobdir:
+        settings['JOBDIR'] = args.jobdir
+    process = CrawlerProcess(settings)
     process.crawl(OcsSpider)
     process.start()
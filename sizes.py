@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Move sizes out of the legacy wide columns into history_availability.
+
+Before history_availability existed, each size's price and availability
+were kept in their own columns of history ("3.5g_price" and so on), and
+only those sizes were stored; history_availability rows from before it had
+a price column have no price.  Running this copies both into
+history_availability, a chunk of runs per transaction, so that every run's
+sizes can be found in the one table.  It can be stopped and started again:
+
+    ./sizes.py [DATABASE]
+"""
+import sys
+import time
+
+import history
+from models import SizeBackfillRun, _get_db_session, backfill_scrape_runs
+
+
+LEGACY_SIZES = ['0.5g', '1g', '1.25g', '1.5g', '2.5g', '3.5g', '5g', '7g',
+                '15g']
+
+# Runs per transaction
+CHUNK_SIZE = 20
+
+INSERT_SIZE = (
+    'INSERT OR IGNORE INTO history_availability'
+    ' (timestamp, brand, name, size, availability, price)'
+    ' SELECT timestamp, brand, name, :size, "{label}_availability",'
+    ' "{label}_price" FROM history'
+    ' WHERE timestamp BETWEEN :first AND :last'
+    ' AND ("{label}_price" IS NOT NULL'
+    ' OR "{label}_availability" IS NOT NULL)')
+
+UPDATE_PRICE = (
+    'UPDATE history_availability SET price = ('
+    'SELECT h."{label}_price" FROM history h'
+    ' WHERE h.timestamp = history_availability.timestamp'
+    ' AND h.brand = history_availability.brand'
+    ' AND h.name = history_availability.name)'
+    ' WHERE timestamp BETWEEN :first AND :last AND size = :size'
+    ' AND price IS NULL')
+
+
+def _legacy_labels(session):
+    """Return the legacy sizes that history has columns for."""
+    columns = {row[1] for row in session.execute('PRAGMA table_info(history)')}
+    return [label for label in LEGACY_SIZES
+            if '{}_price'.format(label) in columns]
+
+
+def backfill_chunk(session, labels, first, last):
+    """Copy the legacy sizes of runs first to last; return rows changed."""
+    changed = 0
+    for label in labels:
+        params = {'first': first, 'last': last,
+                  'size': float(label.strip('g'))}
+        for statement in [INSERT_SIZE, UPDATE_PRICE]:
+            changed += session.execute(
+                statement.format(label=label), params).rowcount
+    return changed
+
+
+def backfill(session, chunk_size=CHUNK_SIZE, progress=False):
+    """Copy legacy sizes for any runs that haven't had them copied."""
+    if history.is_normalized(session.bind):
+        # Conversion already moved the sizes
+        return 0
+    backfill_scrape_runs(session)
+    labels = _legacy_labels(session)
+    timestamps = [row[0] for row in session.execute(
+        'SELECT timestamp FROM scrape_runs'
+        ' WHERE timestamp NOT IN (SELECT timestamp FROM size_backfill_runs)'
+        ' ORDER BY timestamp')]
+    start = time.time()
+    rows = 0
+    for offset in range(0, len(timestamps), chunk_size):
+        chunk = timestamps[offset:offset + chunk_size]
+        changed = backfill_chunk(session, labels, chunk[0], chunk[-1])
+        session.bulk_insert_mappings(
+            SizeBackfillRun, [{'timestamp': timestamp} for timestamp in chunk])
+        session.commit()
+        rows += changed
+        if progress:
+            print('{}/{} runs, {} rows ({:.0f}s)'.format(
+                offset + len(chunk), len(timestamps), rows,
+                time.time() - start))
+    return len(timestamps)
+
+
+if __name__ == '__main__':
+    session = _get_db_session(*sys.argv[1:2])
+    print('Copied sizes for {} runs'.format(backfill(session, progress=True)))